@@ -0,0 +1,174 @@
+# Copyright 2019 New Vector Ltd
+#
+# This file is part of meshsim.
+#
+# meshsim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# meshsim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with coap-proxy.  If not, see <https://www.gnu.org/licenses/>.
+
+# Works out which servers and links carry the most shortest paths, as those
+# are the ones which saturate first when bandwidth is low.
+#
+# Exact (Brandes) betweenness costs a full Dijkstra from every server, which
+# is too slow to redo on every rewire of a big mesh. Instead we follow
+# Riondato & Kornaropoulos, "Fast approximation of betweenness centrality
+# through sampling": pick r random pairs of servers, and one of the shortest
+# paths between each at random, and count how often each server and link
+# turns up. With
+#
+#   r = (c / epsilon^2) * (floor(log2(VD - 2)) + 1 + ln(1 / delta))
+#
+# samples, where VD is the most servers on any shortest path, every estimate
+# is within epsilon of the true value with probability at least 1 - delta.
+# The paper's cheap bound on VD only holds for unweighted graphs, so we just
+# use the number of servers, which only costs us a few more samples as it's
+# under a log.
+#
+# Betweenness here is the fraction of (ordered) pairs of servers whose
+# shortest paths go through the server or link, counting each pair's share of
+# its equally short paths. Servers don't count as being on paths which start
+# or end at them, but links do.
+
+import heapq
+import random
+from math import ceil, floor, log, log2
+
+import networkx as nx
+
+# the universal constant from the paper; 0.5 is what they suggest in practice
+C = 0.5
+
+# the defaults take about 500-700 samples, so we start sampling from roughly
+# 600 servers. Halving epsilon quadruples the samples, and so how big the
+# mesh has to be before sampling pays off.
+EPSILON = 0.1
+DELTA = 0.1
+
+
+def betweenness(graph, epsilon=EPSILON, delta=DELTA, seed=None):
+    """Estimates the node and edge betweenness of the given weighted graph.
+
+    Falls back to calculating them exactly if that would be no slower, i.e.
+    if it would take as many samples as there are nodes.
+
+    Args:
+        graph (nx.Graph): with edge costs as "weight"
+        epsilon (float): the maximum error of each estimate
+        delta (float): the probability of exceeding epsilon
+        seed (int|None): seeds the choice of samples
+
+    Returns:
+        tuple[dict[int, float], dict[tuple[int, int], float], int|None]: the
+        betweenness of each node, of each edge (as (lower id, higher id)),
+        and how many samples were taken, or None if it was calculated exactly.
+    """
+    if not 0 < epsilon < 1 or not 0 < delta < 1:
+        raise ValueError("epsilon and delta must be between 0 and 1")
+
+    rng = random.Random(seed)
+    nodes = list(graph.nodes())
+    n = len(nodes)
+    if n < 3 or graph.number_of_edges() == 0:
+        edges = {_edge(a, b): 0.0 for a, b in graph.edges()}
+        return dict.fromkeys(nodes, 0.0), edges, None
+
+    samples = int(ceil(C / epsilon ** 2 * (floor(log2(n - 2)) + 1 + log(1 / delta))))
+
+    # each sample costs about as much as each of the n Dijkstras of an exact
+    # calculation, so there's no point sampling more than that
+    if samples >= n:
+        return _exact(graph), _exact_edges(graph), None
+
+    node_counts = dict.fromkeys(nodes, 0)
+    edge_counts = {_edge(a, b): 0 for a, b in graph.edges()}
+
+    # sampling pairs is the same as sampling sources and then targets, which
+    # means we only need one Dijkstra per distinct source
+    targets_by_source = {}
+    for _ in range(samples):
+        source, target = rng.sample(nodes, 2)
+        targets_by_source.setdefault(source, []).append(target)
+
+    for source, targets in targets_by_source.items():
+        sigma, preds = _shortest_paths(graph, source)
+        for target in targets:
+            if target not in sigma:
+                continue  # unreachable
+            # walk back from the target, choosing each predecessor in
+            # proportion to how many shortest paths go via it
+            v = target
+            while v != source:
+                choice = rng.random() * sigma[v]
+                for p in preds[v]:
+                    choice -= sigma[p]
+                    if choice < 0:
+                        break
+                edge_counts[_edge(p, v)] += 1
+                if p != source:
+                    node_counts[p] += 1
+                v = p
+
+    return (
+        {i: count / samples for i, count in node_counts.items()},
+        {e: count / samples for e, count in edge_counts.items()},
+        samples,
+    )
+
+
+def _edge(a, b):
+    return (a, b) if a < b else (b, a)
+
+
+def _shortest_paths(graph, source):
+    """Dijkstra from source, counting shortest paths.
+
+    Returns:
+        tuple[dict, dict]: the number of shortest paths to each reachable
+        node, and each node's predecessors on them
+    """
+    dist = {}
+    sigma = {source: 1}
+    preds = {source: []}
+    seen = {source: 0}
+    queue = [(0, source)]
+    while queue:
+        d, v = heapq.heappop(queue)
+        if v in dist:
+            continue
+        dist[v] = d
+        for w, attrs in graph[v].items():
+            cost = d + attrs["weight"]
+            if w not in seen or cost < seen[w]:
+                seen[w] = cost
+                sigma[w] = sigma[v]
+                preds[w] = [v]
+                heapq.heappush(queue, (cost, w))
+            elif cost == seen[w] and w not in dist:
+                sigma[w] += sigma[v]
+                preds[w].append(v)
+    return sigma, preds
+
+
+def _pairs(graph):
+    n = graph.number_of_nodes()
+    return n * (n - 1) / 2
+
+
+def _exact(graph):
+    # networkx counts each unordered pair once
+    values = nx.betweenness_centrality(graph, normalized=False, weight="weight")
+    return {i: value / _pairs(graph) for i, value in values.items()}
+
+
+def _exact_edges(graph):
+    values = nx.edge_betweenness_centrality(graph, normalized=False, weight="weight")
+    return {_edge(a, b): value / _pairs(graph) for (a, b), value in values.items()}
@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 New Vector Ltd
+#
+# This file is part of meshsim.
+#
+# meshsim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# meshsim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with coap-proxy.  If not, see <https://www.gnu.org/licenses/>.
+
+# Host agents are what actually run the homeserver containers.
+#
+# The controller (meshsim.py) always has at least one agent. By default that's
+# a HostAgent which drives the local docker daemon directly via our shell
+# scripts, exactly as meshsim always has. To spread a mesh over several
+# machines, run this file as a daemon on each of them:
+#
+#   ./hostagent.py <DOCKER_HOST_IP> --port 4000
+#
+# ...and point the controller at them with `--agent name=http://host:4000`.
+# Several agents can happily run on the same machine (on different ports) to
+# stand in for separate hosts when testing.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+import aiohttp
+import async_timeout
+from quart import Quart, abort, jsonify, request
+
+from util import int_keys
+
+logger = logging.getLogger(__name__)
+
+KSM_DIR = "/sys/kernel/mm/ksm"
+
+# where a container's memory usage lives, depending on the cgroup version and
+# whether docker uses the systemd or cgroupfs driver
+CGROUP_MEMORY_PATHS = (
+    "/sys/fs/cgroup/system.slice/docker-%s.scope/memory.current",
+    "/sys/fs/cgroup/docker/%s/memory.current",
+    "/sys/fs/cgroup/memory/system.slice/docker-%s.scope/memory.usage_in_bytes",
+    "/sys/fs/cgroup/memory/docker/%s/memory.usage_in_bytes",
+)
+
+
+def read_meminfo():
+    """Returns the host's total and available memory, in bytes, or Nones if
+    we can't tell (e.g. on macOS).
+    """
+    meminfo = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                meminfo[key] = int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        pass
+    return {"total": meminfo.get("MemTotal"), "available": meminfo.get("MemAvailable")}
+
+
+def read_ksm():
+    """Returns the KSM counters, plus how much memory it's saving"""
+    ksm = {}
+    try:
+        names = os.listdir(KSM_DIR)
+    except OSError:
+        return ksm
+
+    for name in names:
+        try:
+            with open(os.path.join(KSM_DIR, name)) as f:
+                ksm[name] = int(f.read())
+        except (OSError, ValueError):
+            continue
+
+    if "pages_sharing" in ksm:
+        ksm["saved"] = ksm["pages_sharing"] * os.sysconf("SC_PAGE_SIZE")
+    return ksm
+
+
+def read_cgroup_memory(container_id):
+    for path in CGROUP_MEMORY_PATHS:
+        try:
+            with open(path % container_id) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+class HostAgent(object):
+    """Runs homeserver containers on the local docker daemon.
+
+    `address` is where the containers' published ports (synapse, topologiser,
+    CoAP) can be reached from the controller. `capacity` is a relative weight
+    used when placing servers: an agent with capacity 2 is given twice as many
+    servers as one with capacity 1.
+    """
+
+    def __init__(self, name, address="localhost", capacity=1):
+        self.name = name
+        self.address = address
+        self.capacity = capacity
+
+        # ids of the servers we're currently hosting
+        self.servers = set()
+
+    def load(self):
+        return len(self.servers) / self.capacity
+
+    async def start_hs(self, server_id, host_ip, ports):
+        # we count the server as ours before starting it, so that cleanup
+        # removes its container even if it only got part way
+        self.servers.add(server_id)
+        proc = await asyncio.create_subprocess_exec(
+            "./start_hs.sh",
+            str(server_id),
+            host_ip,
+            str(ports["synapse"]),
+            str(ports["topologiser"]),
+            str(ports["coap"]),
+        )
+        code = await proc.wait()
+        if code != 0:
+            raise Exception("Failed to start HS")
+
+    async def get_network_info(self, server_id):
+        proc = await asyncio.create_subprocess_exec(
+            "./get_hs_ip.sh", str(server_id), stdout=asyncio.subprocess.PIPE
+        )
+        stdout, _ = await proc.communicate()
+        ip = stdout.decode().strip()
+
+        proc = await asyncio.create_subprocess_exec(
+            "./get_hs_mac.sh", str(server_id), stdout=asyncio.subprocess.PIPE
+        )
+        stdout, _ = await proc.communicate()
+        mac = stdout.decode().strip()
+
+        return ip, mac
+
+    async def list_hs(self, all_containers=False):
+        """Returns the IDs of our running homeserver containers, or of every
+        one on the docker daemon if `all_containers`, e.g. to find those we
+        started before a restart.
+        """
+        proc = await asyncio.create_subprocess_exec(
+            "docker",
+            "container",
+            "ls",
+            "-f",
+            "name=synapse",
+            "-f",
+            "status=running",
+            "--format",
+            "{{.Names}}",
+            stdout=asyncio.subprocess.PIPE,
+        )
+        stdout, _ = await proc.communicate()
+        # other agents may be sharing the docker daemon
+        return [
+            int(name[len("synapse") :])
+            for name in stdout.decode().split()
+            if name[len("synapse") :].isdigit()
+            and (all_containers or int(name[len("synapse") :]) in self.servers)
+        ]
+
+    async def stop_hs(self, server_id):
+        proc = await asyncio.create_subprocess_exec("./stop_hs.sh", str(server_id))
+        await proc.wait()
+        self.servers.discard(server_id)
+
+    async def get_resources(self):
+        """Returns how much memory the host has, how much each homeserver
+        container is using, and how well KSM is sharing it between them.
+        """
+        proc = await asyncio.create_subprocess_exec(
+            "docker",
+            "container",
+            "ls",
+            "--no-trunc",
+            "-f",
+            "name=synapse",
+            "--format",
+            "{{.ID}} {{.Names}}",
+            stdout=asyncio.subprocess.PIPE,
+        )
+        stdout, _ = await proc.communicate()
+
+        containers = {}
+        for line in stdout.decode().splitlines():
+            container_id, _, name = line.partition(" ")
+            if (
+                name[len("synapse") :].isdigit()
+                and int(name[len("synapse") :]) in self.servers
+            ):
+                containers[int(name[len("synapse") :])] = read_cgroup_memory(
+                    container_id
+                )
+
+        return {
+            "memory": read_meminfo(),
+            "ksm": read_ksm(),
+            "containers": containers,
+        }
+
+    async def close(self):
+        pass
+
+    def cleanup(self):
+        # called from atexit, so has to be synchronous. We only stop our own
+        # containers, as other agents may be sharing the docker daemon.
+        procs = [
+            subprocess.Popen(["./stop_hs.sh", str(server_id)])
+            for server_id in self.servers
+        ]
+        for proc in procs:
+            proc.wait()
+        self.servers = set()
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.name)
+
+
+class RemoteHostAgent(HostAgent):
+    """Runs homeserver containers on another host via its hostagent.py daemon.
+    """
+
+    def __init__(self, name, url, address=None, capacity=1):
+        super().__init__(
+            name, address=address or urlparse(url).hostname, capacity=capacity
+        )
+        self.url = url.rstrip("/")
+
+        # created lazily, as it has to be within the event loop
+        self._session = None
+
+    async def _request(self, method, path, json=None):
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        async with async_timeout.timeout(300):
+            async with self._session.request(
+                method, self.url + path, json=json
+            ) as response:
+                if response.status != 200:
+                    raise Exception(
+                        "Agent %s failed %s %s: %s"
+                        % (self.name, method, path, await response.text())
+                    )
+                return await response.json()
+
+    async def start_hs(self, server_id, host_ip, ports):
+        self.servers.add(server_id)
+        await self._request(
+            "PUT", "/hs/%d" % server_id, {"host": host_ip, "ports": ports}
+        )
+
+    async def get_network_info(self, server_id):
+        info = await self._request("GET", "/hs/%d" % server_id)
+        return info["ip"], info["mac"]
+
+    async def list_hs(self, all_containers=False):
+        path = "/hs?all=1" if all_containers else "/hs"
+        return (await self._request("GET", path))["servers"]
+
+    async def get_resources(self):
+        resources = await self._request("GET", "/resources")
+        resources["containers"] = int_keys(resources["containers"])
+        return resources
+
+    async def stop_hs(self, server_id):
+        await self._request("DELETE", "/hs/%d" % server_id)
+        self.servers.discard(server_id)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def cleanup(self):
+        # we tell the agent which servers are ours, in case it has been
+        # restarted since starting them
+        data = json.dumps({"servers": sorted(self.servers)}).encode()
+        try:
+            urlopen(
+                Request(
+                    self.url + "/hs",
+                    data=data,
+                    headers={"Content-Type": "application/json"},
+                    method="DELETE",
+                ),
+                timeout=60,
+            )
+        except Exception as e:
+            logger.warning("Failed to clean up agent %s: %s", self.name, e)
+        self.servers = set()
+
+
+def parse_agent(spec):
+    """Parses an agent spec of the form `name=url[,capacity=N][,address=A]`
+    """
+    name, _, rest = spec.partition("=")
+    if not name or not rest:
+        raise argparse.ArgumentTypeError("Agent must be given as NAME=URL")
+
+    url, *options = rest.split(",")
+    kwargs = {}
+    for option in options:
+        key, _, value = option.partition("=")
+        if key == "capacity":
+            kwargs["capacity"] = float(value)
+        elif key == "address":
+            kwargs["address"] = value
+        else:
+            raise argparse.ArgumentTypeError("Unknown agent option %r" % key)
+
+    return RemoteHostAgent(name, url, **kwargs)
+
+
+def make_app(agent, host_ip):
+    app = Quart(__name__)
+
+    @app.route("/status", methods=["GET"])
+    def on_get_status():
+        return jsonify(
+            {
+                "name": agent.name,
+                "address": agent.address,
+                "capacity": agent.capacity,
+                "servers": sorted(agent.servers),
+            }
+        )
+
+    @app.route("/hs/<int:server_id>", methods=["PUT"])
+    async def on_start_hs(server_id):
+        # {
+        #   "host": "172.18.0.1",
+        #   "ports": {
+        #       "synapse": 18000,
+        #       "topologiser": 19000,
+        #       "coap": 20000
+        #   }
+        # }
+        incoming_json = await request.get_json()
+        if not incoming_json:
+            abort(400, "No JSON provided!")
+            return
+
+        await agent.start_hs(
+            server_id, host_ip or incoming_json["host"], incoming_json["ports"]
+        )
+        ip, mac = await agent.get_network_info(server_id)
+        return jsonify({"ip": ip, "mac": mac})
+
+    @app.route("/hs/<int:server_id>", methods=["GET"])
+    async def on_get_hs(server_id):
+        ip, mac = await agent.get_network_info(server_id)
+        return jsonify({"ip": ip, "mac": mac})
+
+    @app.route("/hs/<int:server_id>", methods=["DELETE"])
+    async def on_stop_hs(server_id):
+        await agent.stop_hs(server_id)
+        return jsonify({})
+
+    @app.route("/hs", methods=["GET"])
+    async def on_list_hs():
+        return jsonify(
+            {"servers": await agent.list_hs(all_containers="all" in request.args)}
+        )
+
+    @app.route("/resources", methods=["GET"])
+    async def on_get_resources():
+        return jsonify(await agent.get_resources())
+
+    @app.route("/hs", methods=["DELETE"])
+    async def on_stop_all():
+        # {
+        #   "servers": [1, 5, ...]  # optional, the controller's servers on
+        #                           # this agent
+        # }
+        incoming_json = await request.get_json(silent=True) or {}
+        agent.servers.update(incoming_json.get("servers", []))
+        agent.cleanup()
+        return jsonify({})
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Meshsim host agent.")
+    parser.add_argument(
+        "host",
+        nargs="?",
+        help="The IP address of this host in the docker network. "
+        "Defaults to whatever the controller uses.",
+    )
+    parser.add_argument(
+        "--port", "-p", help="The port to listen on", default=4000, type=int
+    )
+    parser.add_argument(
+        "--name", help="The name of this agent", default=os.uname().nodename
+    )
+    parser.add_argument(
+        "--address",
+        help="The address at which the controller can reach this host's containers",
+        default="localhost",
+    )
+    args = parser.parse_args()
+
+    # our scripts are all relative to the checkout
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    agent = HostAgent(args.name, address=args.address)
+    app = make_app(agent, args.host)
+    app.run(host="0.0.0.0", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 New Vector Ltd
+#
+# This file is part of meshsim.
+#
+# meshsim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# meshsim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with coap-proxy.  If not, see <https://www.gnu.org/licenses/>.
+
+# Generates Matrix traffic across the homeservers in a mesh.
+#
+# Every server's synapse is seeded by start_hs.sh with an `@matthew:synapseN`
+# user whose access token is `fake_token`. We check those accounts work, have
+# the first server create a public room and everyone else join it over
+# federation, and then send messages into it from randomly chosen servers at
+# a fixed open-loop rate: arrivals are scheduled independently of how quickly
+# earlier sends complete, so a slow mesh builds up a backlog rather than
+# quietly throttling the load.
+#
+# We record how long each send takes to be acknowledged by its server, and
+# how long it takes to show up in /sync on every other server.
+#
+# The controller drives this via `POST /load`, but it can also be pointed at
+# any servers directly, e.g. the stub in tests/matrix_stub.py when testing:
+#
+#   python tests/matrix_stub.py --servers 2 --port 18000 &
+#   ./loadgen.py --target 0=http://localhost:18000 --target 1=http://localhost:18001
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+import uuid
+from urllib.parse import quote
+
+import aiohttp
+import async_timeout
+from tenacity import retry, stop_after_delay, wait_fixed
+
+logger = logging.getLogger(__name__)
+
+ARRIVALS = ("poisson", "burst")
+
+# how many events we ask for in each /sync or /messages. When more than this
+# arrive between syncs, /sync leaves the rest out, and we page back through
+# /messages for them.
+SYNC_LIMIT = 100
+
+
+def percentiles(samples):
+    """Summarises latencies (in seconds) as percentiles in milliseconds"""
+    if not samples:
+        return {"count": 0}
+
+    samples = sorted(samples)
+
+    def rank(p):
+        index = min(int(p / 100 * len(samples)), len(samples) - 1)
+        return round(samples[index] * 1000, 1)
+
+    return {
+        "count": len(samples),
+        "p50": rank(50),
+        "p90": rank(90),
+        "p99": rank(99),
+        "max": round(samples[-1] * 1000, 1),
+    }
+
+
+class LoadGenerator(object):
+    """Sends messages into a room shared by the given servers.
+
+    Args:
+        targets (dict[int, str]): the base URL of each server's client API,
+            by server ID
+        rate (float): messages per second, across all servers
+        arrivals (str): "poisson" for exponentially distributed gaps between
+            messages, or "burst" to send `burst_size` at once every
+            `burst_size / rate` seconds
+        burst_size (int)
+        duration (float): how long to send for, in seconds
+        seed (int|None): seeds the choice of arrival times and senders
+        token (str): the access token of the seeded user on every server
+        join_timeout (float): how long to keep retrying joins for, in seconds
+        drain_time (float): how long to wait for the last messages to turn
+            up in /sync once we've stopped sending, in seconds
+    """
+
+    def __init__(
+        self,
+        targets,
+        rate=1,
+        arrivals="poisson",
+        burst_size=10,
+        duration=60,
+        seed=None,
+        token="fake_token",
+        join_timeout=30,
+        drain_time=10,
+    ):
+        if not targets:
+            raise ValueError("No servers to generate load against")
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if arrivals not in ARRIVALS:
+            raise ValueError("arrivals must be one of %s" % ", ".join(ARRIVALS))
+        if burst_size < 1:
+            raise ValueError("burst_size must be at least 1")
+
+        self.targets = dict(targets)
+        self.rate = rate
+        self.arrivals = arrivals
+        self.burst_size = burst_size
+        self.duration = duration
+        self.seed = seed
+        self.token = token
+        self.join_timeout = join_timeout
+        self.drain_time = drain_time
+
+        self.rng = random.Random(seed)
+        # tags our messages, so we don't count anyone else's
+        self.run_id = uuid.UUID(int=self.rng.getrandbits(128)).hex
+
+        self.state = "idle"
+        self.error = None
+        self.room_id = None
+        self.joined = []  # the servers which made it into the room
+        self.sent = 0
+        self.failed = 0
+        self.send_latencies = []
+        self.sync_latencies = []
+        # how many sync latencies we expect, i.e. one for each server other
+        # than the sender which each message got to
+        self.expected_syncs = 0
+        # how many syncs left events out, and how many of those we couldn't
+        # page back for
+        self.limited_syncs = 0
+        self.failed_backfills = 0
+
+        # txn_id -> (sending server, when we started sending it)
+        self._sent_at = {}
+        self._next_txn = 0
+        self._session = None
+        self._stopping = None
+
+    def url(self, server_id, path, params=None):
+        params = dict(params or {}, access_token=self.token)
+        query = "&".join(
+            "%s=%s" % (k, quote(str(v), safe="")) for k, v in params.items()
+        )
+        return "%s/_matrix/client/r0%s?%s" % (self.targets[server_id], path, query)
+
+    async def _request(
+        self, method, server_id, path, body=None, params=None, timeout=30
+    ):
+        async with async_timeout.timeout(timeout):
+            async with self._session.request(
+                method, self.url(server_id, path, params), json=body
+            ) as response:
+                if response.status != 200:
+                    raise Exception(
+                        "%s %s on %d failed: %d %s"
+                        % (
+                            method,
+                            path,
+                            server_id,
+                            response.status,
+                            await response.text(),
+                        )
+                    )
+                return await response.json()
+
+    async def run(self):
+        """Sets up the room, sends messages for `duration` seconds and returns
+        the stats.
+        """
+        self._stopping = asyncio.Event()
+        self.state = "setting up"
+        async with aiohttp.ClientSession() as self._session:
+            syncs = []
+            try:
+                await self._setup()
+
+                syncs = [
+                    asyncio.ensure_future(self._sync_loop(server_id))
+                    for server_id in self.joined
+                ]
+                # give the syncs a chance to get their initial batch tokens
+                await asyncio.sleep(1)
+
+                self.state = "running"
+                await self._send_loop()
+
+                self.state = "draining"
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), self.drain_time)
+                except asyncio.TimeoutError:
+                    pass
+                self.state = "finished"
+            except Exception as e:
+                logger.exception("Load generation failed")
+                self.state = "failed"
+                self.error = str(e)
+            finally:
+                for sync in syncs:
+                    sync.cancel()
+
+        return self.stats()
+
+    def stop(self):
+        if self._stopping:
+            self._stopping.set()
+
+    async def _setup(self):
+        # make sure the seeded accounts are there before we rely on them
+        await asyncio.gather(
+            *(self._request("GET", i, "/account/whoami") for i in self.targets)
+        )
+
+        creator = min(self.targets)
+        alias = "loadgen_" + self.run_id[:8]
+        response = await self._request(
+            "POST",
+            creator,
+            "/createRoom",
+            {"preset": "public_chat", "room_alias_name": alias},
+        )
+        self.room_id = response["room_id"]
+        self.joined = [creator]
+
+        room = "#%s:synapse%d" % (alias, creator)
+        results = await asyncio.gather(
+            *(self._join(i, room) for i in self.targets if i != creator),
+            return_exceptions=True,
+        )
+        for server_id, result in zip(
+            (i for i in self.targets if i != creator), results
+        ):
+            if isinstance(result, Exception):
+                logger.warning(
+                    "Server %d failed to join %s: %s", server_id, room, result
+                )
+            else:
+                self.joined.append(server_id)
+
+    async def _join(self, server_id, room):
+        # the room may take a while to become reachable over federation
+        @retry(
+            wait=wait_fixed(1), stop=stop_after_delay(self.join_timeout), reraise=True
+        )
+        async def join():
+            await self._request(
+                "POST", server_id, "/join/%s" % quote(room, safe=""), {}
+            )
+
+        await join()
+
+    async def _send_loop(self):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        next_at = start
+        sends = set()
+
+        while not self._stopping.is_set() and next_at < start + self.duration:
+            await asyncio.sleep(max(0, next_at - loop.time()))
+
+            count = self.burst_size if self.arrivals == "burst" else 1
+            for _ in range(count):
+                send = asyncio.ensure_future(self._send(self.rng.choice(self.joined)))
+                sends.add(send)
+                send.add_done_callback(sends.discard)
+
+            if self.arrivals == "burst":
+                next_at += self.burst_size / self.rate
+            else:
+                next_at += self.rng.expovariate(self.rate)
+
+        if sends:
+            await asyncio.wait(sends)
+
+    async def _send(self, server_id):
+        txn_id = "%s_%d" % (self.run_id, self._next_txn)
+        self._next_txn += 1
+        started = time.monotonic()
+        self._sent_at[txn_id] = (server_id, started)
+        try:
+            await self._request(
+                "PUT",
+                server_id,
+                "/rooms/%s/send/m.room.message/%s"
+                % (quote(self.room_id, safe=""), txn_id),
+                {
+                    "msgtype": "m.text",
+                    "body": "load from synapse%d" % server_id,
+                    "loadgen_txn": txn_id,
+                },
+            )
+        except Exception as e:
+            logger.info("Send from %d failed: %s", server_id, e)
+            self.failed += 1
+            del self._sent_at[txn_id]
+            return
+        self.sent += 1
+        self.expected_syncs += len(self.joined) - 1
+        self.send_latencies.append(time.monotonic() - started)
+
+    async def _sync_loop(self, server_id):
+        # only the room's latest events matter to us
+        timeline_filter = json.dumps({"room": {"timeline": {"limit": SYNC_LIMIT}}})
+        since = None
+        while True:
+            params = {"filter": timeline_filter, "timeout": 30000 if since else 0}
+            if since:
+                params["since"] = since
+            try:
+                response = await self._request(
+                    "GET", server_id, "/sync", params=params, timeout=60
+                )
+            except Exception as e:
+                logger.info("Sync on %d failed: %s", server_id, e)
+                await asyncio.sleep(1)
+                continue
+
+            received = time.monotonic()
+            if since:
+                await self._on_sync(server_id, response, received, since)
+            since = response["next_batch"]
+
+    async def _on_sync(self, server_id, response, received, since):
+        room = response.get("rooms", {}).get("join", {}).get(self.room_id, {})
+        timeline = room.get("timeline", {})
+        events = timeline.get("events", [])
+        if timeline.get("limited"):
+            # everything we page back for had arrived by the time of this
+            # sync, so counts as received along with it
+            self.limited_syncs += 1
+            try:
+                events = (
+                    await self._backfill(server_id, timeline["prev_batch"], since)
+                    + events
+                )
+            except Exception as e:
+                logger.info("Backfill on %d failed: %s", server_id, e)
+                self.failed_backfills += 1
+
+        for event in events:
+            txn_id = event.get("content", {}).get("loadgen_txn")
+            if txn_id not in self._sent_at:
+                continue
+            sender, started = self._sent_at[txn_id]
+            # we only care how long it took to get to the other servers
+            if sender != server_id:
+                self.sync_latencies.append(received - started)
+
+    async def _backfill(self, server_id, start, end):
+        """Pages back through the room from `start` to `end`, returning the
+        events in between.
+        """
+        events = []
+        token = start
+        while True:
+            response = await self._request(
+                "GET",
+                server_id,
+                "/rooms/%s/messages" % quote(self.room_id, safe=""),
+                params={"from": token, "to": end, "dir": "b", "limit": SYNC_LIMIT},
+            )
+            chunk = response.get("chunk", [])
+            events += chunk
+            if not chunk or response.get("end") in (None, token):
+                return events
+            token = response["end"]
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "error": self.error,
+            "room_id": self.room_id,
+            "servers": sorted(self.joined),
+            "sent": self.sent,
+            "failed": self.failed,
+            "send_latency": percentiles(self.send_latencies),
+            "sync_latency": percentiles(self.sync_latencies),
+            # sync latencies we haven't (yet) seen, e.g. as the message
+            # hasn't got there or a sync left it out
+            "sync_missing": max(self.expected_syncs - len(self.sync_latencies), 0),
+            "limited_syncs": self.limited_syncs,
+            "failed_backfills": self.failed_backfills,
+        }
+
+
+def parse_target(spec):
+    """Parses a target of the form `id=url`"""
+    server_id, _, url = spec.partition("=")
+    if not server_id.isdigit() or not url:
+        raise argparse.ArgumentTypeError("Target must be given as ID=URL")
+    return int(server_id), url.rstrip("/")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Matrix load generator.")
+    parser.add_argument(
+        "--target",
+        help="A server to send load to, as ID=URL (e.g. 0=http://localhost:18000)",
+        type=parse_target,
+        action="append",
+        required=True,
+    )
+    parser.add_argument("--rate", help="Messages per second", default=1, type=float)
+    parser.add_argument("--arrivals", choices=ARRIVALS, default="poisson")
+    parser.add_argument(
+        "--burst-size",
+        help="How many messages to send at once with burst arrivals",
+        default=10,
+        type=int,
+    )
+    parser.add_argument(
+        "--duration", help="How long to send for, in seconds", default=60, type=float
+    )
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "--drain-time",
+        help="How long to wait for messages to arrive after sending stops",
+        default=10,
+        type=float,
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    loadgen = LoadGenerator(
+        dict(args.target),
+        rate=args.rate,
+        arrivals=args.arrivals,
+        burst_size=args.burst_size,
+        duration=args.duration,
+        seed=args.seed,
+        drain_time=args.drain_time,
+    )
+    stats = asyncio.get_event_loop().run_until_complete(loadgen.run())
+    print(json.dumps(stats, indent=4))
+
+
+if __name__ == "__main__":
+    main()
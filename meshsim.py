@@ -20,114 +20,508 @@
 import argparse
 import asyncio
 import atexit
+import copy
+import functools
+import gzip
+import heapq
 import json
 import os
+import struct
 import subprocess
+import time
+from collections import Counter, deque
 from contextlib import contextmanager
-from itertools import combinations
 from logging.config import dictConfig
 from math import sqrt
 
 import aiohttp
 import async_timeout
 import networkx as nx
-from quart import Quart, abort, jsonify, request, send_from_directory, websocket
-from tenacity import retry, wait_fixed
+from quart import (
+    Quart,
+    Response,
+    abort,
+    jsonify,
+    request,
+    send_from_directory,
+    websocket,
+)
+from tenacity import retry, stop_after_delay, wait_fixed
+
+import analytics
+from hostagent import HostAgent, parse_agent
+from loadgen import LoadGenerator, percentiles
+from timeline import Timeline, load_scenario
+from topology import STRATEGIES
+from util import int_keys
 
 args = None
 
-dictConfig({"version": 1, "loggers": {"quart.app": {"level": "INFO"}}})
+# the hosts which we can run homeservers on, keyed by name
+agents = {}
+
+dictConfig(
+    {
+        "version": 1,
+        "formatters": {
+            "default": {
+                "format": "[%(asctime)s] %(levelname)s in %(module)s: %(message)s"
+            }
+        },
+        "handlers": {
+            "console": {"class": "logging.StreamHandler", "formatter": "default"}
+        },
+        "loggers": {
+            "quart.app": {"level": "INFO"},
+            "loadgen": {"level": "INFO", "handlers": ["console"]},
+            "timeline": {"level": "INFO", "handlers": ["console"]},
+            "hostagent": {"level": "INFO", "handlers": ["console"]},
+        },
+    }
+)
 
 app = Quart(__name__)
 
 
-# We need to create this *after* start up so that it binds to correct event loop
-event_notif_queue = None
+# the mesh which the endpoints outside of /mesh/<name> act on
+DEFAULT_MESH = "default"
+
+# the meshes being simulated, by name. They share the host agents and the
+# server ID allocator, so their servers can't clash.
+meshes = {}
+
+# shared by all the meshes' requests to topologisers and synapses, so that
+# they share one connection pool. We need to create this *after* start up so
+# that it binds to correct event loop
+session = None
+
+
+def http_session():
+    global session
+    if session is None:
+        session = aiohttp.ClientSession()
+    return session
 
 
 @app.before_first_request
 def setup():
-    global event_notif_queue
-    event_notif_queue = asyncio.Queue()
+    create_mesh(DEFAULT_MESH)
+
+
+@app.after_serving
+async def close_session():
+    if session is not None:
+        await session.close()
+    for agent in agents.values():
+        await agent.close()
+
+
+async def put(url, data, compress=False):
+    """PUTs some JSON, returning the response status and body"""
+    headers = {"Content-type": "application/json"}
+    data = data.encode()
+    if compress:
+        data = gzip.compress(data)
+        headers["Content-Encoding"] = "gzip"
+
+    async with async_timeout.timeout(30):
+        async with http_session().put(url, data=data, headers=headers) as response:
+            return response.status, await response.text()
+
+
+async def get(url, timeout=30):
+    """GETs some JSON"""
+    async with async_timeout.timeout(timeout):
+        async with http_session().get(url) as response:
+            if response.status != 200:
+                raise Exception(
+                    "GET %s failed: %d %s"
+                    % (url, response.status, await response.text())
+                )
+            return await response.json()
 
 
-async def put(url, data):
-    async with aiohttp.ClientSession() as session, async_timeout.timeout(30):
-        async with session.put(
-            url, data=data, headers={"Content-type": "application/json"}
-        ) as response:
-            return await response.text()
+async def ping(url, timeout=30):
+    """Checks that something is answering HTTP at url, whatever it says"""
+    async with async_timeout.timeout(timeout):
+        async with http_session().get(url) as response:
+            return response.status
 
 
-class Server(object):
-    _id = 0
+class ServerDirectory(object):
+    """The IP and MAC addresses of the started servers.
+
+    Compact route and health payloads refer to servers by ID, and each server's
+    topologiser looks them up in its copy of the directory. The directory is
+    versioned so that it only needs sending when a server starts, stops or
+    changes address, rather than on every rewire.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.servers = {}
+
+    def update(self, servers):
+        entries = {i: (server.ip, server.mac) for i, server in servers.items()}
+        if entries != self.servers:
+            self.servers = entries
+            self.version += 1
+
+    def size(self):
+        """The length of the arrays indexed by server ID"""
+        return max(self.servers) + 1 if self.servers else 0
+
+    def server_dict(self, server_id):
+        ip, mac = self.servers[server_id]
+        return {"id": server_id, "ip": ip, "mac": mac}
+
+    def to_json(self):
+        # {
+        #     version: 3,
+        #     servers: {
+        #         <id>: [<ip>, <mac>], ...
+        #     }
+        # }
+        return {"version": self.version, "servers": self.servers}
+
+    def expand_routes(self, source_id, routes):
+        """Turns compact routes into the original list format"""
+        return [
+            {
+                "dst": self.server_dict(dest_id),
+                "via": (
+                    self.server_dict(routes["next_hops"][dest_id])
+                    if routes["next_hops"][dest_id] is not None
+                    else None
+                ),
+                "cost": routes["costs"][dest_id],
+            }
+            for dest_id in self.servers
+            if dest_id != source_id
+        ]
+
+    def expand_health(self, health):
+        """Turns compact health into the original format"""
+        peers = health["peers"]
+        return {
+            "peers": [
+                {
+                    "peer": self.server_dict(peer_id),
+                    "bandwidth": peers["bandwidth"][i],
+                    "latency": peers["latency"][i],
+                    "jitter": peers["jitter"][i],
+                    "packet_loss": peers["packet_loss"][i],
+                    "duplicate": peers["duplicate"][i],
+                    "reorder": peers["reorder"][i],
+                    "corrupt": peers["corrupt"][i],
+                }
+                for i, peer_id in enumerate(peers["id"])
+            ],
+            "clients": health["clients"],
+            "shaping": health["shaping"],
+        }
+
+
+class ServerAllocator(object):
+    """Hands out server IDs and host ports, recycling those of removed servers.
+
+    Each server gets one port from each of the synapse, topologiser and CoAP
+    ranges, at offset `id` from the start of the range. As IDs are reused, the
+    ranges only need to be as big as the largest number of servers running at
+    once rather than the number ever started.
+    """
+
+    PORT_TYPES = ("synapse", "topologiser", "coap")
+
+    def __init__(
+        self, synapse_port=18000, topologiser_port=19000, coap_port=20000, size=1000
+    ):
+        self.bases = {
+            "synapse": synapse_port,
+            "topologiser": topologiser_port,
+            "coap": coap_port,
+        }
+        self.size = size
+
+        ranges = sorted((base, base + size, t) for t, base in self.bases.items())
+        for (start1, end1, type1), (start2, _, type2) in zip(ranges, ranges[1:]):
+            if start2 < end1:
+                raise ValueError(
+                    "%s ports %d-%d overlap %s ports starting at %d"
+                    % (type1, start1, end1 - 1, type2, start2)
+                )
+        if ranges[-1][1] > 65536:
+            raise ValueError("%s ports exceed 65535" % ranges[-1][2])
+
+        self._next_id = 0
+        self._free_ids = []  # heap of released IDs, so we reuse the lowest first
+
+    def allocate(self):
+        if self._free_ids:
+            return heapq.heappop(self._free_ids)
+
+        if self._next_id >= self.size:
+            raise Exception("No free server IDs (maximum %d servers)" % self.size)
+
+        server_id = self._next_id
+        self._next_id += 1
+        return server_id
+
+    def claim(self, server_id):
+        """Allocates a specific ID, e.g. when reattaching to a running server"""
+        if server_id >= self.size:
+            raise Exception("Server ID %d out of range" % server_id)
+
+        if server_id >= self._next_id:
+            for free_id in range(self._next_id, server_id):
+                heapq.heappush(self._free_ids, free_id)
+            self._next_id = server_id + 1
+        elif server_id in self._free_ids:
+            self._free_ids.remove(server_id)
+            heapq.heapify(self._free_ids)
+        else:
+            raise Exception("Server ID %d already allocated" % server_id)
+        return server_id
+
+    def release(self, server_id):
+        heapq.heappush(self._free_ids, server_id)
+
+    def ports(self, server_id):
+        return {t: base + server_id for t, base in self.bases.items()}
+
+
+allocator = ServerAllocator()
+
+
+class AdmissionError(Exception):
+    """No host has the memory to start another server"""
+
+
+# how much memory we assume a server will use until it shows up in its
+# container's cgroup
+DEFAULT_SERVER_MEMORY = 256 * 1024 * 1024
+
+# the number of servers currently being started on each agent, by name
+starting = {}
+
+# held while deciding where to start a server, so that concurrent additions
+# see each other's reservations
+admission_lock = None
+
+
+async def get_headroom(agent):
+    """Returns how much memory the agent's host has available above the
+    watermark, allowing for the servers which are still starting, or None if
+    it can't tell us.
+    """
+    try:
+        resources = await agent.get_resources()
+    except Exception as e:
+        app.logger.warning("Failed to get resources of agent %s: %s", agent.name, e)
+        return None
+
+    available = resources["memory"]["available"]
+    if available is None:
+        return None
+
+    usages = [u for u in resources["containers"].values() if u is not None]
+    per_server = sum(usages) / len(usages) if usages else DEFAULT_SERVER_MEMORY
+    return (
+        available
+        - starting.get(agent.name, 0) * per_server
+        - args.memory_watermark * 1024 * 1024
+    )
+
+
+async def admit_server():
+    """Picks the least loaded agent with enough memory to start a server on,
+    waiting for one to free up if configured to queue. The server is counted
+    in `starting` for that agent, and the caller must uncount it once it has
+    started.
+
+    Raises:
+        AdmissionError if no agent has enough memory
+    """
+    global admission_lock
+    if admission_lock is None:
+        admission_lock = asyncio.Lock()
+
+    deadline = time.monotonic() + args.admission_timeout
+    while True:
+        async with admission_lock:
+            candidates = list(agents.values())
+            headrooms = await asyncio.gather(*(get_headroom(a) for a in candidates))
+            # if an agent can't tell us how much memory it has, give it the
+            # benefit of the doubt
+            admissible = [
+                agent
+                for agent, headroom in zip(candidates, headrooms)
+                if headroom is None or headroom > 0
+            ]
+            if admissible:
+                agent = min(admissible, key=lambda agent: (agent.load(), agent.name))
+                starting[agent.name] = starting.get(agent.name, 0) + 1
+                return agent
+
+        if args.admission == "reject" or time.monotonic() > deadline:
+            raise AdmissionError(
+                "No host has more than %dMiB of memory available"
+                % args.memory_watermark
+            )
+        app.logger.info("Waiting for memory to free up to start a server")
+        await asyncio.sleep(5)
 
-    def __init__(self, x, y):
+
+# how long to keep retrying a push to a topologiser for, in seconds, before
+# giving up and leaving it to the health checks to take the server out of
+# the mesh
+PUSH_DEADLINE = 30
+
+
+class Server(object):
+    def __init__(self, x, y, server_id=None):
         self.x = x
         self.y = y
-        self.id = Server._id
+        if server_id is None:
+            self.id = allocator.allocate()
+        else:
+            self.id = allocator.claim(server_id)
+        self.ports = allocator.ports(self.id)
         self.ip = None
         self.mac = None
-        Server._id = Server._id + 1
+        self.agent = None
+
+        # the version of the ServerDirectory which our topologiser has
+        self.directory_version = None
 
         self.paths = None  # cache of shortest paths
         self.path_costs = None  # cache of shortest path costs
 
         self.neighbours = set()
 
+        # whether we can reach our topologiser and synapse, and how many
+        # health checks in a row have failed
+        self.healthy = True
+        self.misses = 0
+        # whether the server has been deliberately taken out of the mesh, e.g.
+        # by a timeline, while leaving it running
+        self.up = True
+
     def toDict(self):
         return {"id": self.id, "ip": self.ip, "mac": self.mac}
 
-    async def start(self):
+    def topologiser_url(self, path):
+        return "http://%s:%d%s" % (self.agent.address, self.ports["topologiser"], path)
+
+    def synapse_url(self):
+        return "http://%s:%d" % (self.agent.address, self.ports["synapse"])
+
+    async def start(self, agent):
         global args
-        proc = await asyncio.create_subprocess_exec(
-            "./start_hs.sh", str(self.id), args.host
-        )
-        code = await proc.wait()
-        if code != 0:
-            raise Exception("Failed to start HS")
+        self.agent = agent
+        app.logger.info("starting %d on agent %s", self.id, agent.name)
+
+        # count ourselves against the agent straight away so that concurrent
+        # additions get spread across the other agents. If we fail to start,
+        # we stay counted until stopped, so that the agent's cleanup removes
+        # whatever we left behind.
+        agent.servers.add(self.id)
+        await agent.start_hs(self.id, args.host, self.ports)
+        await self.update_network_info()
+
+    async def reattach(self, agent):
+        """Picks up an already running container, rather than starting one"""
+        self.agent = agent
+        agent.servers.add(self.id)
         await self.update_network_info()
 
     async def update_network_info(self):
-        proc = await asyncio.create_subprocess_exec(
-            "./get_hs_ip.sh", str(self.id), stdout=asyncio.subprocess.PIPE
-        )
-        stdout, _ = await proc.communicate()
-        self.ip = stdout.decode().strip()
+        self.ip, self.mac = await self.agent.get_network_info(self.id)
+
+    async def _push(self, path, payload, directory):
+        """Sends a compact payload to our topologiser, first sending it the
+        directory if it doesn't have the current version.
+        """
+        if args.wire_format == "legacy":
+            data = json.dumps(payload)
+        else:
+            data = json.dumps(
+                dict(payload, version=2, directory_version=directory.version)
+            )
+            if self.directory_version != directory.version:
+                await self.set_directory(directory)
 
-        proc = await asyncio.create_subprocess_exec(
-            "./get_hs_mac.sh", str(self.id), stdout=asyncio.subprocess.PIPE
+        status, r = await put(
+            self.topologiser_url(path), data, compress=args.compress_payloads
+        )
+        if status == 409:
+            # the topologiser has lost its directory, probably by restarting
+            self.directory_version = None
+            await self.set_directory(directory)
+            status, r = await put(
+                self.topologiser_url(path), data, compress=args.compress_payloads
+            )
+        return len(data), status, r
+
+    async def set_directory(self, directory):
+        data = json.dumps(directory.to_json())
+        app.logger.info(
+            "setting directory v%d for %d: %d bytes",
+            directory.version,
+            self.id,
+            len(data),
+        )
+        await put(
+            self.topologiser_url("/directory"), data, compress=args.compress_payloads
         )
-        stdout, _ = await proc.communicate()
-        self.mac = stdout.decode().strip()
+        self.directory_version = directory.version
 
-    @retry(wait=wait_fixed(1))
-    async def set_routes(self, routes):
-        # [
+    @retry(wait=wait_fixed(1), stop=stop_after_delay(PUSH_DEADLINE), reraise=True)
+    async def set_routes(self, routes, directory):
+        # {
+        #     source: 1, # our own ID
+        #     next_hops: [null, 2, 2, 5, ...], # next hop server ID, by destination ID
+        #     costs: [null, 12.5, 30, 8, ...], # path cost, by destination ID
+        # }
+        #
+        # or, if using the legacy wire format, a list of:
+        #
         #   {
         #       dst: server,
-        #       via: server
-        #   }, ...
-        # ]
-        data = json.dumps(routes, indent=4)
-        app.logger.info("setting routes for %d: %s", self.id, data)
-
-        r = await put("http://localhost:%d/routes" % (19000 + self.id), data)
-
-        app.logger.info("Set route with result for %d: %s", self.id, r)
+        #       via: server,
+        #       cost: 12.5,
+        #   }
+        if args.wire_format == "legacy":
+            routes = directory.expand_routes(self.id, routes)
+
+        start = time.monotonic()
+        size, status, r = await self._push("/routes", routes, directory)
+
+        app.logger.info(
+            "Set %d routes for %d (%d bytes) with status %d in %.1fms",
+            sum(1 for via in routes["next_hops"] if via is not None)
+            if isinstance(routes, dict)
+            else len(routes),
+            self.id,
+            size,
+            status,
+            (time.monotonic() - start) * 1000,
+        )
+        app.logger.debug("Set route with result for %d: %s", self.id, r)
 
-    @retry(wait=wait_fixed(1))
-    async def set_network_health(self, health):
+    @retry(wait=wait_fixed(1), stop=stop_after_delay(PUSH_DEADLINE), reraise=True)
+    async def set_network_health(self, health, directory):
         # {
-        #     peers: [
-        #         {
-        #             peer: <server>,
-        #             bandwidth: 300, # 300bps
-        #             latency: 200, # 200ms
-        #             jitter: 20, # +/- 20ms - we apply 25% correlation on jitter
-        #             loss: 0, # 0% packet loss
-        #         }, ...
-        #     ],
+        #     peers: {
+        #         id: [2, 5, ...], # server IDs
+        #         bandwidth: [300, ...], # 300bps
+        #         latency: [200, ...], # 200ms
+        #         jitter: [20, ...], # +/- 20ms - we apply 25% correlation on jitter
+        #         packet_loss: [0, ...], # 0% packet loss
+        #         duplicate: [0, ...], # 0% of packets duplicated
+        #         reorder: [0, ...], # 0% of packets sent ahead of the others
+        #         corrupt: [0, ...], # 0% of packets with a bit flipped
+        #     },
         #     clients: [
         #         {
         #             source_port: 54312,
@@ -136,10 +530,25 @@ class Server(object):
         #             jitter: 20, # +/- 20ms - we apply 25% correlation on jitter
         #             loss: 0, # 0% packet loss
         #         }, ...
-        #     ]
+        #     ],
+        #     shaping: {
+        #         classifier: "hashed",
+        #         profile: "netem",
+        #     }
         # }
-        data = json.dumps(health, indent=4)
-        app.logger.info("setting health for %d: %s", self.id, data)
+        #
+        # or, if using the legacy wire format, with peers as a list of:
+        #
+        #   {
+        #       peer: <server>,
+        #       bandwidth: 300,
+        #       latency: 200,
+        #       jitter: 20,
+        #       packet_loss: 0,
+        #       duplicate: 0,
+        #       reorder: 0,
+        #       corrupt: 0,
+        #   }
 
         # only apply client health on the host side once (picking server 0 arbitrarily)
         if self.id == 0:
@@ -157,12 +566,39 @@ class Server(object):
                     "with host result for %d: %s", self.id, stdout.decode().strip()
                 )
 
-        r = await put("http://localhost:%d/health" % (19000 + self.id), data)
+        peer_count = len(health["peers"]["id"])
+        if args.wire_format == "legacy":
+            health = directory.expand_health(health)
+
+        start = time.monotonic()
+        size, status, r = await self._push("/health", health, directory)
+
+        app.logger.info(
+            "Set health of %d peers for %d (%d bytes) with status %d in %.1fms",
+            peer_count,
+            self.id,
+            size,
+            status,
+            (time.monotonic() - start) * 1000,
+        )
+        app.logger.debug("with result for %d: %s", self.id, r)
+
+    async def check_health(self, timeout):
+        """Checks that our topologiser and synapse are both responding"""
+        await asyncio.gather(
+            # any response will do: older topologisers have no cheap endpoint
+            # (nor /stats), and we don't want to make them run tc just to see
+            # if they're there
+            ping(self.topologiser_url("/"), timeout=timeout),
+            get(self.synapse_url() + "/_matrix/client/versions", timeout=timeout),
+        )
 
-        app.logger.info("with result for %d: %s", self.id, r)
+    async def get_stats(self):
+        """Fetches the traffic counters for each of our peers"""
+        return await get(self.topologiser_url("/stats"))
 
-    def stop(self):
-        subprocess.call(["./stop_hs.sh", str(self.id)])
+    async def stop(self):
+        await self.agent.stop_hs(self.id)
 
     def distance(self, server2):
         return sqrt((server2.x - self.x) ** 2 + (server2.y - self.y) ** 2)
@@ -186,13 +622,67 @@ class Mesh:
 
     COST_MIN_LATENCY = "cost_min_latency"
     COST_MAX_BANDWIDTH = "cost_max_bandwidth"
+    COST_CONGESTION = "cost_congestion"
+
+    # how much weight to give each new measurement of a link's load
+    CONGESTION_SMOOTHING = 0.5
+    # we treat links as no more than this busy, to keep costs finite
+    MAX_UTILISATION = 0.95
+    # how many times its latency a link dropping every packet costs
+    DROP_PENALTY = 10
+
+    COST_FUNCTIONS = (COST_MIN_LATENCY, COST_MAX_BANDWIDTH, COST_CONGESTION)
+
+    # how topologisers pick out the traffic to each peer: a chain of u32
+    # filters under a prio qdisc, or u32 hash tables under htb.
+    # c.f. topologiser/shaping.py
+    CLASSIFIERS = ("linear", "hashed")
+
+    # whether topologisers limit each peer's bandwidth with a tbf (or htb
+    # class) above a netem qdisc, or just with netem's own rate limiting
+    SHAPING_PROFILES = ("tbf", "netem")
+
+    # netem impairments other than delay, jitter & loss, as a % of packets
+    IMPAIRMENTS = ("duplicate", "reorder", "corrupt")
+
+    # the characteristics of a link which can be overridden
+    LINK_FIELDS = ("bandwidth", "latency", "jitter", "packet_loss") + IMPAIRMENTS
+
+    # the binary format of /data, c.f. get_d3_columns
+    D3_COLUMNS_MIMETYPE = "application/vnd.meshsim.columns"
+    D3_COLUMNS_MAGIC = 0x4853454D  # "MESH"
+    D3_COLUMNS_VERSION = 1
+    # (name, struct code) of each column
+    D3_NODE_COLUMNS = (("name", "I"), ("x", "f"), ("y", "f"), ("healthy", "B"))
+    D3_LINK_COLUMNS = (
+        ("source", "I"),
+        ("target", "I"),
+        ("bandwidth", "f"),
+        ("latency", "f"),
+        ("jitter", "f"),
+        ("packet_loss", "f"),
+        ("duplicate", "f"),
+        ("reorder", "f"),
+        ("corrupt", "f"),
+        ("overrides", "H"),
+    )
 
-    def __init__(self, host_ip):
+    def __init__(self, host_ip, name=DEFAULT_MESH, traffic=None):
+        self.name = name
         self.graph = nx.Graph()
         self.servers = {}
 
+        # messages for the UI's websocket
+        self.events = asyncio.Queue()
+        # the PDUs being sent over the mesh, and the load we're generating
+        self.traffic = traffic or TrafficAggregator()
+        self.loadgen = None
+        self.timeline = None
+
         self.rewiring = False
         self.pending_rewire = False
+        # whether this is a copy from planned(), rather than the mesh itself
+        self.planning = False
 
         # global defaults
         self.bandwidth = 512000
@@ -202,7 +692,22 @@ class Mesh:
         self.min_bandwidth = 0
         self.jitter = 0
         self.packet_loss = 0
+        self.duplicate = 0
+        self.reorder = 0
+        self.corrupt = 0
         self.cost_function = Mesh.COST_MIN_LATENCY
+        # how much a link's measured congestion has to change by (relative to
+        # what we last routed with) before we reroute
+        self.congestion_hysteresis = 0.25
+
+        # how we decide which servers to link, c.f. topology.STRATEGIES
+        self.topology = "threshold"
+        self.neighbour_limit = 4
+        self.knn_k = 4
+        self.yao_cones = 6
+
+        self.shaping_classifier = "linear"
+        self.shaping_profile = "tbf"
 
         self.client_bandwidth = 512000
         self.client_latency = 0
@@ -212,6 +717,37 @@ class Mesh:
         # link overrides
         self.overrides = {}
 
+        self.directory = ServerDirectory()
+
+        self.paths = None  # cache of shortest paths
+        self.path_costs = None  # cache of shortest path costs
+
+        # bumped whenever we rewire, so we know when to recalculate analytics
+        self.topology_version = 0
+        # (epsilon, delta) -> betweenness, for the current topology_version
+        self.betweenness = {}
+        self.betweenness_version = None
+        # (origin id, target id) -> (path, latency to each hop), for the
+        # current topology_version
+        self.path_timings = {}
+        self.path_timings_version = None
+
+        # loop-free alternate next hops, as source -> dest -> (via, cost)
+        self.backups = {}
+
+        # the most recent fast failovers, for reporting
+        self.failovers = deque(maxlen=100)
+
+        # the last traffic counters from each server's topologiser, as
+        # id -> (time, generation, {peer id: (bytes, packets, drops)})
+        self.link_stats = {}
+        # smoothed utilisation & drop rate of each link, in each direction, as
+        # (from id, to id) -> (utilisation, drop rate)
+        self.link_load = {}
+        # the multiple of its latency which each link costs under
+        # COST_CONGESTION, as (lower id, higher id) -> factor
+        self.congestion = {}
+
         # Number of things that are about to call rewire. Don't bother rewiring
         # unless this is zero.
         self._about_to_rewire_functions = 0
@@ -223,25 +759,157 @@ class Mesh:
         self.servers[server.id] = server
         self.graph.add_node(server.id)
 
-        with self.will_rewire():
-            await server.start()
+        # admission can wait a long time for memory to free up, so we only
+        # hold off other rewires while the server is actually starting
+        try:
+            agent = await admit_server()
+        except AdmissionError:
+            self.drop_server(server)
+            await self.safe_rewire()
+            raise
+
+        try:
+            with self.will_rewire():
+                try:
+                    await server.start(agent)
+                finally:
+                    starting[agent.name] -= 1
+        except Exception:
+            # clear up whatever it managed to start
+            try:
+                await server.stop()
+            except Exception as e:
+                # we keep hold of its ID so it isn't reused while the
+                # container may still be running; its agent will clean it
+                # up on exit
+                app.logger.warning("Failed to stop server %d: %r", server.id, e)
+                self.drop_server(server, release=False)
+            else:
+                self.drop_server(server)
+            await self.safe_rewire()
+            raise
 
         await self.safe_rewire()
         return server
 
+    def drop_server(self, server, release=True):
+        """Forgets a server which never started, or has been stopped"""
+        del self.servers[server.id]
+        self.graph.remove_node(server.id)
+        self.forget_server(server.id)
+        if release:
+            allocator.release(server.id)
+
     def get_server(self, server_id):
         return self.servers[server_id]
 
+    def get_snapshot(self):
+        return {
+            "servers": [
+                {
+                    "id": server.id,
+                    "x": server.x,
+                    "y": server.y,
+                    "agent": server.agent.name if server.agent else None,
+                }
+                for server in self.servers.values()
+            ],
+            "defaults": self.get_defaults(),
+            "overrides": self.overrides,
+        }
+
+    async def resume(self, snapshot, running):
+        """Restores the mesh from a snapshot, reattaching to whichever of its
+        servers' containers are still running, and then rewires once.
+
+        Args:
+            snapshot (dict): as returned by get_snapshot
+            running (dict[int, dict[str, HostAgent]]): the agents which each
+                running container can be found on, by server ID. The
+                containers we reattach to are removed.
+        """
+        self.set_defaults(snapshot["defaults"])
+        self.overrides = int_keys(snapshot["overrides"], depth=2)
+
+        servers = []
+        for saved in snapshot["servers"]:
+            running_on = running.pop(saved["id"], None)
+            if not running_on:
+                app.logger.warning(
+                    "Server %d is no longer running; dropping it", saved["id"]
+                )
+                continue
+            # agents sharing a docker daemon (e.g. when testing) will all
+            # report the same containers, so we prefer the one the server was
+            # last on.
+            agent = running_on.get(saved["agent"]) or next(iter(running_on.values()))
+            servers.append((Server(saved["x"], saved["y"], saved["id"]), agent))
+
+        with self.will_rewire():
+            await asyncio.gather(
+                *(server.reattach(agent) for server, agent in servers)
+            )
+        for server, _ in servers:
+            self.servers[server.id] = server
+            self.graph.add_node(server.id)
+
+        app.logger.info("Resumed %d servers in mesh %s", len(servers), self.name)
+        await self.safe_rewire()
+
     async def move_server(self, server, x, y):
         server.x = x
         server.y = y
         await self.safe_rewire()
 
     async def remove_server(self, server):
-        server.stop()
-        self.graph.remove_node(server.id)
+        # route around the server before it disappears, leaving the full
+        # rewire to catch up in the background
+        if server.ip is not None and self.paths:
+            await self.fast_failover(failed_server=server)
+
+        await server.stop()
+        self.drop_server(server)
+
+        asyncio.ensure_future(self.safe_rewire())
+
+    def forget_server(self, server_id):
+        """Drops the link overrides and traffic history of a server which has
+        gone, so that they don't carry over to whichever server gets its ID
+        next.
+        """
+        self.overrides.pop(server_id, None)
+        for links in self.overrides.values():
+            links.pop(server_id, None)
+        self.overrides = {
+            server1_id: links for server1_id, links in self.overrides.items() if links
+        }
 
-        await self.safe_rewire()
+        self.link_stats.pop(server_id, None)
+        for _, _, counters in self.link_stats.values():
+            counters.pop(server_id, None)
+        self.link_load = {
+            link: load for link, load in self.link_load.items() if server_id not in link
+        }
+        self.congestion = {
+            link: factor
+            for link, factor in self.congestion.items()
+            if server_id not in link
+        }
+
+    async def update_link_health(self, server1_id, server2_id, health):
+        """Applies a link override, failing over straight away if it takes
+        down a link which is currently in use.
+        """
+        was_linked = self.graph.has_edge(server1_id, server2_id)
+        self.set_link_health(server1_id, server2_id, health)
+
+        if was_linked and not self.within_thresholds(
+            self.get_server(server1_id), self.get_server(server2_id)
+        ):
+            await self.fast_failover(failed_link=(server1_id, server2_id))
+            asyncio.ensure_future(self.safe_rewire())
+        else:
+            await self.safe_rewire()
 
     async def safe_rewire(self):
         if self._about_to_rewire_functions:
@@ -269,118 +937,614 @@ class Mesh:
                 self.pending_rewire = False
                 await self.safe_rewire()
 
-    async def _rewire(self):
+    def get_started_servers(self):
+        # only servers which have started up, have IPs, are still responding
+        # and haven't been taken down can be wired
+        return {
+            i: server
+            for i, server in self.servers.items()
+            if server.ip is not None and server.healthy and server.up
+        }
+
+    async def update_server_health(self, server, healthy):
+        """Takes a server out of the mesh once it has failed enough health
+        checks in a row, and puts it back once it responds again.
+        """
+        if healthy:
+            server.misses = 0
+            if not server.healthy:
+                app.logger.info("Server %d has recovered", server.id)
+                server.healthy = True
+                # it may well have restarted and lost everything we told it
+                server.directory_version = None
+                await self.safe_rewire()
+            return
+
+        server.misses += 1
+        if server.healthy and server.misses >= args.health_misses:
+            app.logger.warning(
+                "Server %d failed %d health checks; removing it from the mesh",
+                server.id,
+                server.misses,
+            )
+            if self.paths:
+                await self.fast_failover(failed_server=server)
+            server.healthy = False
+            await self.safe_rewire()
+
+    def wire(self, started_servers):
+        """Works out the links between the given servers, and the shortest
+        paths over them, without pushing anything to the servers.
+        """
         if self.cost_function == Mesh.COST_MIN_LATENCY:
             cost_function = self.get_latency
         elif self.cost_function == Mesh.COST_MAX_BANDWIDTH:
             cost_function = self.get_bandwidth_cost
+        elif self.cost_function == Mesh.COST_CONGESTION:
+            # we pick links by latency, so that load only changes how we
+            # route over the links rather than which links there are
+            cost_function = self.get_latency
 
-        started_servers = {
-            i: self.servers[i] for i in self.servers if self.servers[i].ip is not None
+        for server in started_servers.values():
+            server.reset_neighbours()
+        self.graph.remove_edges_from(list(self.graph.edges()))
+
+        STRATEGIES[self.topology].wire(self, started_servers, cost_function)
+        if self.cost_function == Mesh.COST_CONGESTION:
+            for server1_id, server2_id, attrs in self.graph.edges(data=True):
+                attrs["weight"] = self.get_congestion_cost(
+                    self.servers[server1_id], self.servers[server2_id]
+                )
+        self.topology_version += 1
+
+        self.paths = dict(nx.shortest_path(self.graph, weight="weight"))
+        self.path_costs = dict(nx.shortest_path_length(self.graph, weight="weight"))
+        self.backups = self.get_backups(started_servers)
+
+    def planned(self, wired=False):
+        """Returns a copy of the mesh which can be changed and rewired without
+        affecting this one, or pushing anything to the servers.
+
+        Only the things which changes and rewiring touch are copied; the
+        rest is shared with this mesh.
+
+        Args:
+            wired (bool): whether to keep the current links, e.g. to compare
+                a plan against, rather than leaving them to be rewired
+        """
+        view = copy.copy(self)
+        view.planning = True
+        if wired:
+            view.graph = self.graph.copy()
+        else:
+            view.graph = nx.Graph()
+            view.graph.add_nodes_from(self.graph.nodes())
+        view.overrides = {
+            server1_id: {server2_id: dict(o) for server2_id, o in links.items()}
+            for server1_id, links in self.overrides.items()
         }
+        view.servers = {}
+        for server_id, server in self.servers.items():
+            view.servers[server_id] = copy.copy(server)
+        for server in view.servers.values():
+            server.neighbours = (
+                {view.servers[n.id] for n in server.neighbours} if wired else set()
+            )
+        return view
+
+    async def plan(self, changes):
+        """Works out what a set of changes would do to the mesh, without
+        making them.
+
+        Args:
+            changes (dict): any of
+                positions: {<id>: {x: 120, y: 562}, ...}
+                links: [{source: 1, target: 2, latency: 100, ...}, ...], as
+                    for PUT /link, where a null clears the override
+                defaults: as for PUT /defaults
+
+        Returns:
+            dict: the servers whose routes or peer health would change, the
+            links which would be added & removed, the changed next hops, and
+            the path stretch before and after.
+
+        Raises:
+            ValueError (or KeyError, TypeError) if the changes are invalid
+        """
+        # as with _rewire, the wiring happens off the event loop, so we work
+        # on copies of the mesh as it is now and as it would be
+        before = self.planned(wired=True)
+        view = self.planned()
+
+        if "defaults" in changes:
+            view.set_defaults(changes["defaults"])
+
+        for server_id, position in changes.get("positions", {}).items():
+            server = view.servers.get(int(server_id))
+            if not server:
+                raise ValueError("No such server %s" % (server_id,))
+            server.x = position["x"]
+            server.y = position["y"]
+
+        for link in changes.get("links", []):
+            server1_id, server2_id = sorted((int(link["source"]), int(link["target"])))
+            view.set_link_health(server1_id, server2_id, link)
+
+        return await asyncio.get_event_loop().run_in_executor(
+            None, before.compare, view
+        )
 
-        # only try to wire servers which have started up and have IPs
-        for server in started_servers.values():
-            # Uncomment if we want to recheck IP/mac addresses of the containers:
-            # await server.update_network_info()
+    def compare(self, view):
+        """Rewires a changed copy of the mesh and compares it with this one,
+        as described by plan.
+        """
+        started_servers = view.get_started_servers()
+        view.wire(started_servers)
+
+        before_edges = {tuple(sorted(edge)) for edge in self.graph.edges()}
+        after_edges = {tuple(sorted(edge)) for edge in view.graph.edges()}
+
+        routes_changed = set()
+        health_changed = set()
+        next_hops = []
+        for source_id in started_servers:
+            before_paths = (self.paths or {}).get(source_id, {})
+            after_paths = view.paths.get(source_id, {})
+            before_costs = (self.path_costs or {}).get(source_id, {})
+            after_costs = view.path_costs.get(source_id, {})
+
+            for dest_id in started_servers:
+                if dest_id == source_id:
+                    continue
+                before = before_paths.get(dest_id, [])
+                after = after_paths.get(dest_id, [])
+                before_via = before[1] if len(before) > 1 else None
+                after_via = after[1] if len(after) > 1 else None
+                if before_via != after_via:
+                    routes_changed.add(source_id)
+                    next_hops.append(
+                        {
+                            "source": source_id,
+                            "destination": dest_id,
+                            "before": before_via,
+                            "after": after_via,
+                        }
+                    )
+                elif before_costs.get(dest_id) != after_costs.get(dest_id):
+                    routes_changed.add(source_id)
 
-            server.reset_neighbours()
-            self.graph.remove_edges_from(list(self.graph.edges()))
+            if _health_key(self.get_health(source_id)) != _health_key(
+                view.get_health(source_id)
+            ):
+                health_changed.add(source_id)
 
-        # first we wire anyone closer together than our thresholds
-        for server1, server2 in combinations(started_servers.values(), 2):
-            latency = self.get_latency(server1, server2)
-            bandwidth = self.get_bandwidth(server1, server2)
+        return {
+            "servers_changed": len(routes_changed | health_changed),
+            "routes_changed": sorted(routes_changed),
+            "health_changed": sorted(health_changed),
+            "edges": {
+                "added": sorted(after_edges - before_edges),
+                "removed": sorted(before_edges - after_edges),
+            },
+            "next_hops": next_hops,
+            "stretch": {
+                "before": self.get_stretch(self.get_started_servers()),
+                "after": view.get_stretch(started_servers),
+            },
+        }
 
-            if latency < self.max_latency and bandwidth > self.min_bandwidth:
-                server1.connect(server2)
+    def get_stretch(self, servers):
+        """How much longer routes are than direct links would be: the mean
+        and max ratio of each route's latency to that of a direct link.
+        """
+        ratios = []
+        unreachable = 0
+        for source_id in servers:
+            paths = (self.paths or {}).get(source_id, {})
+            for dest_id in servers:
+                if dest_id == source_id:
+                    continue
+                path = paths.get(dest_id)
+                if not path:
+                    unreachable += 1
+                    continue
+                direct = self.get_latency(servers[source_id], servers[dest_id])
+                if direct <= 0:
+                    continue
+                routed = sum(
+                    self.get_latency(self.servers[a], self.servers[b])
+                    for a, b in zip(path, path[1:])
+                )
+                ratios.append(routed / direct)
 
-        # then we reset the wirings and rewire the closest 4 neighbours.
-        # we do this in two phases as we need to have all the possible
-        # neighbours in place from both 'i' and 'j' sides of the matrix before
-        # we know which are actually closest.
-        for server in started_servers.values():
-            neighbour_costs = {
-                s.id: cost_function(server, s) for s in server.neighbours
-            }
-            server.reset_neighbours()
-            for (j, cost) in sorted(neighbour_costs.items(), key=lambda x: x[1])[0:4]:
-                if server.connect(started_servers[j], 4):
-                    self.graph.add_edge(server.id, j, weight=cost)
+        return {
+            "mean": sum(ratios) / len(ratios) if ratios else None,
+            "max": max(ratios) if ratios else None,
+            "unreachable": unreachable,
+        }
 
-        self.paths = nx.shortest_path(self.graph, weight="weight")
-        self.path_costs = dict(nx.shortest_path_length(self.graph, weight="weight"))
+    def build(self, started_servers):
+        """Wires the given servers and works out what to push to each of them.
+
+        This only touches the mesh's links and paths, so can be run off the
+        event loop on a copy of the mesh from planned().
+
+        Returns:
+            tuple[dict, dict]: the routes and health of each server, by ID
+        """
+        self.wire(started_servers)
+        routes = {i: self.get_routes(i, started_servers) for i in started_servers}
+        health = {i: self.get_health(i) for i in started_servers}
+        return routes, health
+
+    def adopt(self, view):
+        """Takes on the links and paths which a copy of the mesh from planned()
+        has been wired with.
+        """
+        # servers may have come or gone while the copy was being wired; the
+        # rewire which that queued up will wire them in properly
+        graph = view.graph
+        graph.remove_nodes_from([i for i in list(graph) if i not in self.servers])
+        graph.add_nodes_from(self.servers)
+        self.graph = graph
+
+        for server_id, server in self.servers.items():
+            wired = view.servers.get(server_id)
+            server.neighbours = (
+                {self.servers[n.id] for n in wired.neighbours if n.id in self.servers}
+                if wired
+                else set()
+            )
+
+        self.topology_version = view.topology_version
+        self.paths = view.paths
+        self.path_costs = view.path_costs
+        self.backups = view.backups
+
+    async def _rewire(self):
+        # Uncomment if we want to recheck IP/mac addresses of the containers:
+        # for server in self.get_started_servers().values():
+        #     await server.update_network_info()
+
+        # the wiring can take seconds for big meshes, so we keep it off the
+        # event loop. It works on a copy of the mesh, as servers may move and
+        # defaults change meanwhile (each of which queues up another rewire).
+        view = self.planned()
+        started_servers = view.get_started_servers()
+        self.directory.update(started_servers)
+        directory = self.directory
+
+        start = time.monotonic()
+        routes, health = await asyncio.get_event_loop().run_in_executor(
+            None, view.build, started_servers
+        )
+        self.adopt(view)
 
         # app.logger.info("calculated shortest paths as %r", self.paths)
 
-        c = list(combinations(started_servers, 2))
-        app.logger.info("combinations %r", c)
+        app.logger.info(
+            "Wired %d servers with %d links in %.1fms",
+            len(started_servers),
+            self.graph.number_of_edges(),
+            (time.monotonic() - start) * 1000,
+        )
+
+        # we push to the servers themselves rather than the copies
+        started_servers = {
+            i: self.servers[i] for i in started_servers if i in self.servers
+        }
+
+        # make sure everyone has the directory before anything refers to it
+        if args.wire_format != "legacy":
+            await asyncio.gather(
+                *(
+                    server.set_directory(directory)
+                    for server in started_servers.values()
+                    if server.directory_version != directory.version
+                ),
+                # _push retries the directory for anyone who missed it
+                return_exceptions=True,
+            )
 
         futures = (
             # apply the network topology in terms of routing table
             [
-                self.get_server(source_id).set_routes(
-                    [
-                        {
-                            "dst": self.get_server(dest_id).toDict(),
-                            "via": (
-                                self.get_server(
-                                    self.paths[source_id][dest_id][1]
-                                ).toDict()
-                                if len(self.paths[source_id].get(dest_id, [])) > 1
-                                else None
-                            ),
-                            "cost": self.path_costs[source_id].get(dest_id),
-                        }
-                        for dest_id in started_servers
-                        if source_id != dest_id
-                    ]
-                )
-                for source_id in started_servers
+                server.set_routes(routes[i], directory)
+                for i, server in started_servers.items()
             ]
             +
             # apply the network characteristics to the peers
             [
-                self.get_server(i).set_network_health(
-                    {
-                        "peers": [
-                            {
-                                "peer": neighbour.toDict(),
-                                "bandwidth": self.get_bandwidth(
-                                    self.get_server(i), neighbour
-                                ),
-                                "latency": self.get_latency(
-                                    self.get_server(i), neighbour
-                                ),
-                                "jitter": self.get_jitter(
-                                    self.get_server(i), neighbour
-                                ),
-                                "packet_loss": self.get_packet_loss(
-                                    self.get_server(i), neighbour
-                                ),
-                            }
-                            for neighbour in self.get_server(i).neighbours
-                        ],
-                        "clients": [
-                            {
-                                "source_port": 0,  # FIXME once we support multiple clients
-                                "bandwidth": self.client_bandwidth,
-                                "latency": self.client_latency,
-                                "jitter": self.client_jitter,
-                                "loss": self.client_loss,
-                            }
-                        ],
-                    }
-                )
-                for i in started_servers
+                server.set_network_health(health[i], directory)
+                for i, server in started_servers.items()
             ]
         )
 
-        await asyncio.gather(*futures)
+        # a server which doesn't respond in time mustn't hold up the rest, and
+        # the health checks will take it out of the mesh if it's gone
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        failed = sorted(
+            {
+                i
+                for i, result in zip(list(started_servers) * 2, results)
+                if isinstance(result, Exception)
+            }
+        )
+        if failed:
+            app.logger.warning("Failed to update servers %s", failed)
+
+    def get_health(self, server_id):
+        server = self.get_server(server_id)
+        neighbours = list(server.neighbours)
+        return {
+            "peers": {
+                "id": [neighbour.id for neighbour in neighbours],
+                "bandwidth": [self.get_bandwidth(server, n) for n in neighbours],
+                "latency": [self.get_latency(server, n) for n in neighbours],
+                "jitter": [self.get_jitter(server, n) for n in neighbours],
+                "packet_loss": [self.get_packet_loss(server, n) for n in neighbours],
+                "duplicate": [
+                    self.get_impairment(server, n, "duplicate") for n in neighbours
+                ],
+                "reorder": [
+                    self.get_impairment(server, n, "reorder") for n in neighbours
+                ],
+                "corrupt": [
+                    self.get_impairment(server, n, "corrupt") for n in neighbours
+                ],
+            },
+            "clients": [
+                {
+                    "source_port": 0,  # FIXME once we support multiple clients
+                    "bandwidth": self.client_bandwidth,
+                    "latency": self.client_latency,
+                    "jitter": self.client_jitter,
+                    "loss": self.client_loss,
+                }
+            ],
+            "shaping": {
+                "classifier": self.shaping_classifier,
+                "profile": self.shaping_profile,
+            },
+        }
+
+    def get_routes(self, source_id, servers, failed_hops=(), dead=()):
+        """Builds the routing table for a server, as arrays of next hop and
+        cost indexed by destination server ID.
+
+        Args:
+            source_id (int): the server to build the routes for
+            servers (dict[int, Server]): the servers to route to
+            failed_hops (set[int]): neighbours which can no longer be used as
+                next hops, and should be replaced by their backups
+            dead (set[int]): servers which should no longer be routed to
+        """
+        size = self.directory.size()
+        next_hops = [None] * size
+        costs = [None] * size
+
+        paths = self.paths[source_id]
+        path_costs = self.path_costs[source_id]
+        backups = self.backups.get(source_id, {})
+
+        for dest_id in servers:
+            if dest_id == source_id or dest_id in dead:
+                continue
+
+            path = paths.get(dest_id, [])
+            via = path[1] if len(path) > 1 else None
+            cost = path_costs.get(dest_id)
+
+            if via in failed_hops:
+                via, cost = backups.get(dest_id, (None, None))
+
+            next_hops[dest_id] = via
+            costs[dest_id] = cost
+
+        return {"source": source_id, "next_hops": next_hops, "costs": costs}
+
+    def get_backups(self, servers):
+        """Picks a loop-free alternate next hop for each route, if there is one.
+
+        A neighbour n of s is a loop-free alternate for reaching d if
+        dist(n, d) < dist(n, s) + dist(s, d), i.e. n won't send the traffic
+        straight back to s. We prefer alternates which also avoid the primary
+        next hop p, i.e. dist(n, d) < dist(n, p) + dist(p, d), so that they
+        still work if p itself fails rather than just the link to it.
+
+        Returns:
+            dict[int, dict[int, tuple[int, float]]]: source -> dest -> (via, cost)
+        """
+        backups = {}
+        for source_id in servers:
+            source_costs = self.path_costs.get(source_id, {})
+            for dest_id, path in self.paths.get(source_id, {}).items():
+                if len(path) < 2:
+                    continue
+                primary = path[1]
+
+                best = None
+                for neighbour in self.graph.neighbors(source_id):
+                    if neighbour == primary:
+                        continue
+                    neighbour_costs = self.path_costs.get(neighbour, {})
+                    if dest_id not in neighbour_costs:
+                        continue
+                    if (
+                        neighbour_costs[dest_id]
+                        >= neighbour_costs[source_id] + source_costs[dest_id]
+                    ):
+                        continue
+
+                    node_protecting = dest_id == primary or (
+                        neighbour_costs[dest_id]
+                        < neighbour_costs.get(primary, float("inf"))
+                        + self.path_costs[primary].get(dest_id, float("inf"))
+                    )
+                    cost = (
+                        self.graph[source_id][neighbour]["weight"]
+                        + neighbour_costs[dest_id]
+                    )
+                    if best is None or (not node_protecting, cost) < best[0]:
+                        best = ((not node_protecting, cost), neighbour, cost)
+
+                if best:
+                    backups.setdefault(source_id, {})[dest_id] = (best[1], best[2])
+        return backups
+
+    async def fast_failover(self, failed_link=None, failed_server=None):
+        """Installs the precomputed backup routes on just the servers next to
+        a failed link or server, without waiting for a full rewire.
+
+        The caller is responsible for following this up with a rewire.
+        """
+        start = time.monotonic()
+
+        started_servers = self.get_started_servers()
+
+        if failed_link:
+            server1_id, server2_id = failed_link
+            failed_hops = {server1_id: {server2_id}, server2_id: {server1_id}}
+            dead = set()
+            failure = "link %d-%d" % failed_link
+        else:
+            failed_hops = {
+                neighbour.id: {failed_server.id}
+                for neighbour in failed_server.neighbours
+            }
+            dead = {failed_server.id}
+            failure = "server %d" % failed_server.id
+
+        # we can only route to servers which the topologisers know about
+        routable = {
+            i: server
+            for i, server in started_servers.items()
+            if i in self.directory.servers
+        }
+
+        affected = [i for i in failed_hops if i in routable]
+        # a neighbour which doesn't respond mustn't stop the others failing
+        # over, nor hold up whatever the caller does next
+        results = await asyncio.gather(
+            *(
+                self.get_server(i).set_routes(
+                    self.get_routes(i, routable, failed_hops[i], dead),
+                    self.directory,
+                )
+                for i in affected
+            ),
+            return_exceptions=True,
+        )
+        failed = {}
+        for i, result in zip(affected, results):
+            if isinstance(result, Exception):
+                app.logger.warning(
+                    "Failed to fail over %s on %d: %r", failure, i, result
+                )
+                failed[i] = repr(result)
+
+        duration = time.monotonic() - start
+        app.logger.info(
+            "Failed over %s on %d servers in %.1fms (%d failed)",
+            failure,
+            len(affected) - len(failed),
+            duration * 1000,
+            len(failed),
+        )
+        self.failovers.append(
+            {
+                "failure": failure,
+                "servers": affected,
+                "failed": failed,
+                "duration_ms": duration * 1000,
+                "time": time.time(),
+            }
+        )
+
+    def within_thresholds(self, server1, server2):
+        return (
+            self.get_latency(server1, server2) < self.max_latency
+            and self.get_bandwidth(server1, server2) > self.min_bandwidth
+        )
 
     def get_bandwidth_cost(self, server1, server2):
         return 1 / self.get_bandwidth(server1, server2)
 
+    def get_congestion_cost(self, server1, server2):
+        key = (min(server1.id, server2.id), max(server1.id, server2.id))
+        return self.get_latency(server1, server2) * self.congestion.get(key, 1)
+
+    def update_link_stats(self, server_id, stats, now):
+        """Updates the load on each of a server's links from its traffic
+        counters, as returned by its topologiser's /stats.
+        """
+        peers = stats["peers"]
+        counters = {
+            peer_id: (peers["bytes"][i], peers["packets"][i], peers["drops"][i])
+            for i, peer_id in enumerate(peers["id"])
+        }
+        last = self.link_stats.get(server_id)
+        self.link_stats[server_id] = (now, stats["generation"], counters)
+
+        # the counters are reset whenever the server's shaping is rebuilt
+        if not last or last[1] != stats["generation"] or now <= last[0]:
+            return
+
+        server = self.get_server(server_id)
+        elapsed = now - last[0]
+        alpha = Mesh.CONGESTION_SMOOTHING
+        for peer_id, (sent, packets, drops) in counters.items():
+            if peer_id not in last[2] or peer_id not in self.servers:
+                continue
+            last_sent, last_packets, last_drops = last[2][peer_id]
+            bandwidth = self.get_bandwidth(server, self.get_server(peer_id))
+
+            utilisation = (
+                (sent - last_sent) * 8 / elapsed / bandwidth if bandwidth > 0 else 1
+            )
+            attempts = (packets - last_packets) + (drops - last_drops)
+            drop_rate = (drops - last_drops) / attempts if attempts else 0
+
+            old = self.link_load.get((server_id, peer_id), (utilisation, drop_rate))
+            self.link_load[(server_id, peer_id)] = (
+                alpha * utilisation + (1 - alpha) * old[0],
+                alpha * drop_rate + (1 - alpha) * old[1],
+            )
+
+    def update_congestion(self):
+        """Recalculates the congestion factor of each link from its load,
+        ignoring changes smaller than congestion_hysteresis so that routes
+        don't flap.
+
+        Returns:
+            bool: whether any link's factor changed
+        """
+        changed = False
+        congestion = {}
+        for server1_id, server2_id in self.graph.edges():
+            key = (min(server1_id, server2_id), max(server1_id, server2_id))
+            # a link is as congested as its busiest direction
+            loads = [
+                self.link_load.get((server1_id, server2_id), (0, 0)),
+                self.link_load.get((server2_id, server1_id), (0, 0)),
+            ]
+            utilisation = min(max(u for u, _ in loads), Mesh.MAX_UTILISATION)
+            drop_rate = max(d for _, d in loads)
+
+            # queueing delay grows as u / (1 - u) for an M/M/1 queue
+            factor = (
+                1 + utilisation / (1 - utilisation) + Mesh.DROP_PENALTY * drop_rate
+            )
+            old = self.congestion.get(key, 1)
+            if abs(factor - old) > self.congestion_hysteresis * old:
+                changed = True
+                congestion[key] = factor
+            else:
+                congestion[key] = old
+
+        self.congestion = congestion
+        return changed
+
     def get_bandwidth(self, server1, server2):
         if server1.id > server2.id:
             tmp = server1
@@ -436,23 +1600,112 @@ class Mesh:
 
         return self.packet_loss
 
-    def set_link_health(self, server1_id, server2_id, health):
-        override = {}
-        for t in ["bandwidth", "latency", "jitter", "packet_loss"]:
-            if t in health:
-                override[t] = int(health.get(t)) if health.get(t) is not None else None
+    def get_impairment(self, server1, server2, impairment):
+        """Gets one of IMPAIRMENTS for a link"""
+        if server1.id > server2.id:
+            server1, server2 = server2, server1
 
-        self.overrides.setdefault(server1_id, {}).setdefault(server2_id, {}).update(
-            override
-        )
-        app.logger.info("link health overrides now %r", self.overrides)
+        override = self.overrides.get(server1.id, {}).get(server2.id, None)
+        if override and override.get(impairment) is not None:
+            return override[impairment]
+
+        return getattr(self, impairment)
+
+    def set_link_health(self, server1_id, server2_id, health):
+        self.set_links_health([(server1_id, server2_id, health)])
+
+    def set_links_health(self, links):
+        """Applies several link overrides at once.
+
+        Args:
+            links (list[tuple[int, int, dict]]): the servers at each end of
+                the link, and the characteristics to override (or None to go
+                back to the default)
+        """
+        for server1_id, server2_id, health in links:
+            override = {}
+            for t in Mesh.LINK_FIELDS:
+                if t in health:
+                    override[t] = (
+                        int(health.get(t)) if health.get(t) is not None else None
+                    )
+
+            self.overrides.setdefault(server1_id, {}).setdefault(
+                server2_id, {}
+            ).update(override)
+        if not self.planning:
+            app.logger.info("link health overrides now %r", self.overrides)
+
+    def apply_events(self, events):
+        """Applies a batch of timeline events, leaving the caller to rewire"""
+        links = []
+        for event in events:
+            if "link" in event:
+                health = event.get("set") or dict.fromkeys(event["clear"])
+                links.append(event["link"] + (health,))
+            elif event["server"] in self.servers:
+                self.servers[event["server"]].up = event["state"] == "up"
+            else:
+                app.logger.warning(
+                    "Timeline refers to unknown server %d", event["server"]
+                )
+        if links:
+            self.set_links_health(links)
 
     def get_d3_data(self):
+        return json.dumps(self._get_d3_data(), sort_keys=True)
+
+    def get_d3_columns(self):
+        """Packs the mesh into little-endian typed arrays, which browsers can
+        read straight into Uint32Arrays, Float32Arrays etc. without parsing.
+
+        The layout is a header of 4 uint32s (D3_COLUMNS_MAGIC, the format
+        version, the number of nodes and the number of links) followed by each
+        of D3_NODE_COLUMNS and then each of D3_LINK_COLUMNS in turn, each
+        padded to a multiple of 4 bytes. Bit i of a link's "overrides" is set
+        if LINK_FIELDS[i] is overridden for it.
+        """
+        data = self._get_d3_data()
+        nodes = data["nodes"]
+        links = data["links"]
+        for link in links:
+            overrides = link.get("overrides", {})
+            link["overrides"] = sum(
+                1 << i for i, field in enumerate(Mesh.LINK_FIELDS) if field in overrides
+            )
+
+        chunks = [
+            struct.pack(
+                "<4I",
+                Mesh.D3_COLUMNS_MAGIC,
+                Mesh.D3_COLUMNS_VERSION,
+                len(nodes),
+                len(links),
+            )
+        ]
+        for rows, columns in (
+            (nodes, Mesh.D3_NODE_COLUMNS),
+            (links, Mesh.D3_LINK_COLUMNS),
+        ):
+            for name, code in columns:
+                chunk = struct.pack(
+                    "<%d%s" % (len(rows), code), *(row[name] for row in rows)
+                )
+                chunks.append(chunk + b"\0" * (-len(chunk) % 4))
+        return b"".join(chunks)
+
+    def _get_d3_data(self):
         data = {"nodes": [], "links": []}
 
-        # XXX: frontend relies on index in data.nodes matches the server ID
         for _, server in sorted(self.servers.items()):
-            data["nodes"].append({"name": server.id, "x": server.x, "y": server.y})
+            data["nodes"].append(
+                {
+                    "name": server.id,
+                    "x": server.x,
+                    "y": server.y,
+                    "healthy": server.healthy and server.up,
+                }
+            )
             for neighbour in server.neighbours:
                 if server.id < neighbour.id:
                     link = {
@@ -463,6 +1716,10 @@ class Mesh:
                         "jitter": self.get_jitter(server, neighbour),
                         "packet_loss": self.get_packet_loss(server, neighbour),
                     }
+                    for impairment in Mesh.IMPAIRMENTS:
+                        link[impairment] = self.get_impairment(
+                            server, neighbour, impairment
+                        )
 
                     overrides = self.overrides.get(server.id, {}).get(neighbour.id, {})
                     for override in overrides:
@@ -471,7 +1728,7 @@ class Mesh:
 
                     data["links"].append(link)
 
-        return json.dumps(data, sort_keys=True, indent=4)
+        return data
 
     def get_costs(self):
         if not self.path_costs:
@@ -479,9 +1736,75 @@ class Mesh:
         return self.paths_costs
 
     def get_path(self, origin, target):
-        if not self.paths:
-            self.paths = nx.shortest_path(self.graph, weight="weight")
-        return self.paths[origin][target]
+        return self.get_path_timing(origin, target)[0]
+
+    def get_path_timing(self, origin, target):
+        """Returns the path from one server to another, and how long it takes
+        to get to each server along it.
+
+        These are cached until the next rewire, as we look one up for every
+        PDU sent.
+
+        Returns:
+            tuple[list[int], list[float]]: the IDs of the servers along the
+            path, and the total latency (in ms) to reach each of them. Both
+            are empty if there is no path.
+        """
+        if self.path_timings_version != self.topology_version:
+            self.path_timings = {}
+            self.path_timings_version = self.topology_version
+
+        key = (origin, target)
+        if key not in self.path_timings:
+            if self.paths:
+                path = self.paths.get(origin, {}).get(target, [])
+            else:
+                try:
+                    path = nx.shortest_path(self.graph, origin, target, weight="weight")
+                except (nx.NetworkXNoPath, nx.NodeNotFound):
+                    path = []
+
+            times = [0] if path else []
+            for a, b in zip(path, path[1:]):
+                times.append(
+                    times[-1] + self.get_latency(self.servers[a], self.servers[b])
+                )
+            self.path_timings[key] = (path, times)
+        return self.path_timings[key]
+
+    async def get_betweenness(self, epsilon, delta):
+        """Estimates how many shortest paths go through each server and link,
+        c.f. analytics.betweenness.
+        """
+        if self.betweenness_version != self.topology_version:
+            self.betweenness = {}
+            self.betweenness_version = self.topology_version
+
+        version = self.topology_version
+        if (epsilon, delta) not in self.betweenness:
+            # this can take seconds for big meshes, so keep it off the loop,
+            # working on a copy in case we rewire meanwhile
+            nodes, edges, samples = await asyncio.get_event_loop().run_in_executor(
+                None,
+                analytics.betweenness,
+                self.graph.copy(),
+                epsilon,
+                delta,
+                version,
+            )
+            result = {
+                "version": version,
+                "epsilon": epsilon,
+                "delta": delta,
+                "samples": samples,
+                "nodes": [[i, value] for i, value in sorted(nodes.items())],
+                "links": [[a, b, value] for (a, b), value in sorted(edges.items())],
+            }
+            if version != self.topology_version:
+                # stale already, so don't cache it
+                return result
+            self.betweenness[(epsilon, delta)] = result
+        return self.betweenness[(epsilon, delta)]
 
     def get_defaults(self):
         return {
@@ -491,7 +1814,17 @@ class Mesh:
             "min_bandwidth": self.min_bandwidth,
             "jitter": self.jitter,
             "packet_loss": self.packet_loss,
+            "duplicate": self.duplicate,
+            "reorder": self.reorder,
+            "corrupt": self.corrupt,
             "cost_function": self.cost_function,
+            "congestion_hysteresis": self.congestion_hysteresis,
+            "topology": self.topology,
+            "neighbour_limit": self.neighbour_limit,
+            "knn_k": self.knn_k,
+            "yao_cones": self.yao_cones,
+            "shaping_classifier": self.shaping_classifier,
+            "shaping_profile": self.shaping_profile,
             "latency_scale": self.latency_scale,
             "client_latency": self.client_latency,
             "client_bandwidth": self.client_bandwidth,
@@ -500,6 +1833,19 @@ class Mesh:
         }
 
     def set_defaults(self, defaults):
+        topology = defaults.get("topology", self.topology)
+        if topology not in STRATEGIES:
+            raise ValueError("Unknown topology strategy %r" % (topology,))
+        shaping_classifier = defaults.get("shaping_classifier", self.shaping_classifier)
+        if shaping_classifier not in Mesh.CLASSIFIERS:
+            raise ValueError("Unknown shaping classifier %r" % (shaping_classifier,))
+        shaping_profile = defaults.get("shaping_profile", self.shaping_profile)
+        if shaping_profile not in Mesh.SHAPING_PROFILES:
+            raise ValueError("Unknown shaping profile %r" % (shaping_profile,))
+        cost_function = defaults.get("cost_function", self.cost_function)
+        if cost_function not in Mesh.COST_FUNCTIONS:
+            raise ValueError("Unknown cost function %r" % (cost_function,))
+
         self.bandwidth = int(defaults.get("bandwidth", self.bandwidth))
         self.decay_bandwidth = bool(
             defaults.get("decay_bandwidth", self.decay_bandwidth)
@@ -508,8 +1854,22 @@ class Mesh:
         self.min_bandwidth = int(defaults.get("min_bandwidth", self.min_bandwidth))
         self.jitter = int(defaults.get("jitter", self.jitter))
         self.packet_loss = int(defaults.get("packet_loss", self.packet_loss))
-        self.cost_function = defaults.get("cost_function", self.cost_function)
-        self.latency_scale = int(defaults.get("latency_scale", self.jitter))
+        self.duplicate = int(defaults.get("duplicate", self.duplicate))
+        self.reorder = int(defaults.get("reorder", self.reorder))
+        self.corrupt = int(defaults.get("corrupt", self.corrupt))
+        self.cost_function = cost_function
+        self.congestion_hysteresis = float(
+            defaults.get("congestion_hysteresis", self.congestion_hysteresis)
+        )
+        self.topology = topology
+        self.neighbour_limit = int(
+            defaults.get("neighbour_limit", self.neighbour_limit)
+        )
+        self.knn_k = int(defaults.get("knn_k", self.knn_k))
+        self.yao_cones = int(defaults.get("yao_cones", self.yao_cones))
+        self.shaping_classifier = shaping_classifier
+        self.shaping_profile = shaping_profile
+        self.latency_scale = int(defaults.get("latency_scale", self.latency_scale))
         self.client_latency = int(defaults.get("client_latency", self.client_latency))
         self.client_bandwidth = int(
             defaults.get("client_bandwidth", self.client_bandwidth)
@@ -526,11 +1886,215 @@ class Mesh:
             self._about_to_rewire_functions -= 1
 
 
-mesh = Mesh("")
+def _health_key(health):
+    """Puts a server's health in a form which can be compared, regardless
+    of what order its peers are in.
+    """
+    peers = health["peers"]
+    fields = sorted(field for field in peers if field != "id")
+    return (
+        {
+            peer_id: tuple(peers[field][i] for field in fields)
+            for i, peer_id in enumerate(peers["id"])
+        },
+        json.dumps(health["clients"], sort_keys=True),
+        json.dumps(health["shaping"], sort_keys=True),
+    )
+
+
+class TrafficAggregator(object):
+    """Turns PDU send/receive telemetry into per-link and per-server counters,
+    which are emitted as one frame per interval rather than one websocket
+    message per PDU.
+
+    In "auto" mode we only aggregate when the event rate exceeds
+    `aggregate_above` events/s, and go back to per-event messages once it
+    drops below `aggregate_below`.
+    """
+
+    MODES = ("auto", "events", "aggregate")
+
+    # how long we remember PDUs which haven't been received yet
+    IN_FLIGHT_EXPIRY = 60
+
+    def __init__(
+        self, mode="auto", interval=0.1, aggregate_above=100, aggregate_below=50
+    ):
+        self.mode = mode
+        self.interval = interval
+        self.aggregate_above = aggregate_above
+        self.aggregate_below = aggregate_below
+
+        self.auto_aggregating = False
+        self.rate = 0  # events/s over the last interval
+        self._events = 0
+
+        # counters for the current interval
+        self.link_sent = Counter()  # (id1, id2) -> PDUs sent over the link
+        self.server_sent = Counter()
+        self.server_received = Counter()
+
+        # PDUs which have been sent but not yet received, and the links they
+        # were sent over, as (event_id, dest_id) -> (time, links)
+        self.pending = {}
+        self.in_flight = Counter()  # (id1, id2) -> PDUs in flight over the link
+
+    def aggregating(self):
+        if self.mode == "auto":
+            return self.auto_aggregating
+        return self.mode == "aggregate"
+
+    def on_sending(self, event_id, origin_id, dest_id, path):
+        self._events += 1
+        self.server_sent[origin_id] += 1
+
+        # a resend replaces the original, which we'll never hear about
+        _, resent = self.pending.pop((event_id, dest_id), (None, ()))
+        for link in resent:
+            self._land(link)
+
+        links = [(min(a, b), max(a, b)) for a, b in zip(path, path[1:])]
+        for link in links:
+            self.link_sent[link] += 1
+            self.in_flight[link] += 1
+        self.pending[(event_id, dest_id)] = (time.monotonic(), links)
+
+    def on_received(self, event_id, origin_id, dest_id):
+        self._events += 1
+        self.server_received[dest_id] += 1
+
+        _, links = self.pending.pop((event_id, dest_id), (None, ()))
+        for link in links:
+            self._land(link)
+
+    def _land(self, link):
+        self.in_flight[link] -= 1
+        if self.in_flight[link] <= 0:
+            del self.in_flight[link]
+
+    def frame(self):
+        """Returns the counters for the interval just gone, and resets them"""
+        self.rate = self._events / self.interval
+        self._events = 0
+        if self.auto_aggregating and self.rate < self.aggregate_below:
+            self.auto_aggregating = False
+        elif not self.auto_aggregating and self.rate > self.aggregate_above:
+            self.auto_aggregating = True
+
+        now = time.monotonic()
+        for key, (sent_at, links) in list(self.pending.items()):
+            if now - sent_at > TrafficAggregator.IN_FLIGHT_EXPIRY:
+                del self.pending[key]
+                for link in links:
+                    self._land(link)
+
+        servers = set(self.server_sent) | set(self.server_received)
+        links = set(self.link_sent) | set(self.in_flight)
+        frame = {
+            "event_type": "aggregate",
+            "interval": self.interval,
+            "rate": self.rate,
+            # [source, target, sent, in flight]
+            "links": [
+                [a, b, self.link_sent[(a, b)], self.in_flight[(a, b)]]
+                for a, b in sorted(links)
+            ],
+            # [id, sent, received]
+            "servers": [
+                [i, self.server_sent[i], self.server_received[i]]
+                for i in sorted(servers)
+            ],
+        }
+
+        self.link_sent.clear()
+        self.server_sent.clear()
+        self.server_received.clear()
+        return frame
+
 
+class LoopLagMonitor(object):
+    """Measures how much later than asked for the event loop wakes us up, which
+    is how long it has been blocked for by synchronous work.
+    """
 
-@app.route("/")
-def send_index():
+    def __init__(self, interval=0.1, window=600):
+        self.interval = interval
+        self.samples = deque(maxlen=window)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0, loop.time() - start - self.interval))
+
+    def stats(self):
+        """Returns the percentiles of the lag over the last `window` samples"""
+        stats = percentiles(self.samples)
+        stats["window"] = len(self.samples) * self.interval
+        return stats
+
+
+loop_lag = LoopLagMonitor()
+
+
+def create_mesh(name):
+    mesh = Mesh(
+        "",
+        name=name,
+        traffic=TrafficAggregator(
+            mode=args.traffic_mode,
+            interval=1 / args.frame_rate,
+            aggregate_above=args.aggregate_above,
+            aggregate_below=args.aggregate_below,
+        ),
+    )
+    meshes[name] = mesh
+    return mesh
+
+
+def get_mesh_of_server(server_id):
+    for mesh in meshes.values():
+        if server_id in mesh.servers:
+            return mesh
+    return None
+
+
+def _mesh_view(register, rule, options):
+    """Registers a view at `rule` for the default mesh, and at
+    `/mesh/<name><rule>` for the named one. The view is passed the mesh to
+    act on as its first argument.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(mesh_name=DEFAULT_MESH, **kwargs):
+            mesh = meshes.get(mesh_name)
+            if mesh is None:
+                abort(404, "No such mesh")
+                return
+            result = view(mesh, **kwargs)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+
+        register(rule, **options)(wrapper)
+        register("/mesh/<mesh_name>" + rule, **options)(wrapper)
+        return wrapper
+
+    return decorator
+
+
+def mesh_route(rule, **options):
+    return _mesh_view(app.route, rule, options)
+
+
+def mesh_websocket(rule, **options):
+    return _mesh_view(app.websocket, rule, options)
+
+
+@mesh_route("/")
+def send_index(mesh):
     return send_from_directory("", "index.html")
 
 
@@ -539,8 +2103,71 @@ def send_static(filename):
     return send_from_directory("static/", filename)
 
 
-@app.route("/server", methods=["POST"])
-async def on_add_server():
+@app.route("/mesh", methods=["GET"])
+def on_get_meshes():
+    return jsonify(
+        {name: len(mesh.servers) for name, mesh in sorted(meshes.items())}
+    )
+
+
+@app.route("/mesh/<mesh_name>", methods=["PUT"])
+async def on_create_mesh(mesh_name):
+    # optionally, the new mesh's defaults:
+    # {
+    #   "max_latency": 400,
+    #   ...
+    # }
+    if mesh_name in meshes:
+        abort(409, "Mesh already exists")
+        return
+
+    defaults = await request.get_json() or {}
+    try:
+        create_mesh(mesh_name).set_defaults(defaults)
+    except ValueError as e:
+        del meshes[mesh_name]
+        abort(400, str(e))
+        return
+    return ""
+
+
+@app.route("/mesh/<mesh_name>", methods=["DELETE"])
+async def on_remove_mesh(mesh_name):
+    if mesh_name == DEFAULT_MESH:
+        abort(400, "Can't remove the default mesh")
+        return
+    mesh = meshes.pop(mesh_name, None)
+    if mesh is None:
+        abort(404, "No such mesh")
+        return
+
+    if mesh.loadgen:
+        mesh.loadgen.stop()
+    if mesh.timeline:
+        mesh.timeline.stop()
+
+    # there's no point failing over onto neighbours which are going too, so
+    # we just stop everything
+    servers = list(mesh.servers.values())
+    results = await asyncio.gather(
+        *(server.stop() for server in servers), return_exceptions=True
+    )
+    for server, result in zip(servers, results):
+        if isinstance(result, Exception):
+            # we keep hold of its ID so it isn't reused while the container
+            # may still be running; its agent will clean it up on exit
+            app.logger.warning(
+                "Failed to stop server %d of mesh %s: %r", server.id, mesh_name, result
+            )
+        else:
+            allocator.release(server.id)
+    mesh.servers = {}
+    mesh.graph.clear()
+    return ""
+
+
+@mesh_route("/server", methods=["POST"])
+async def on_add_server(mesh):
     # {
     #   "x": 120,
     #   "y": 562
@@ -553,12 +2180,16 @@ async def on_add_server():
     x = incoming_json.get("x")
     y = incoming_json.get("y")
 
-    server = await mesh.add_server(Server(x, y))
+    try:
+        server = await mesh.add_server(Server(x, y))
+    except AdmissionError as e:
+        abort(503, str(e))
+        return
     return jsonify({"id": server.id})
 
 
-@app.route("/server/<server_id>/position", methods=["PUT"])
-async def on_position_server(server_id):
+@mesh_route("/server/<server_id>/position", methods=["PUT"])
+async def on_position_server(mesh, server_id):
     # {
     #   "x": 120,
     #   "y": 562
@@ -578,6 +2209,17 @@ async def on_position_server(server_id):
     return ""
 
 
+@mesh_route("/server/<server_id>", methods=["DELETE"])
+async def on_remove_server(mesh, server_id):
+    server_id = int(server_id)
+    if server_id not in mesh.servers:
+        abort(404, "No such server")
+        return
+
+    await mesh.remove_server(mesh.get_server(server_id))
+    return ""
+
+
 def name_to_id(name):
     return int(name.replace("synapse", ""))
 
@@ -587,11 +2229,22 @@ async def on_incoming_log():
     args = request.args
     server = args["server"]
     msg = args["msg"]
+
+    # server IDs are unique across meshes, so we can tell which this is for
+    mesh = get_mesh_of_server(name_to_id(server))
+    if mesh is None:
+        return ""
+    traffic = mesh.traffic
+
     if msg == "ReceivedPDU":
         event_id = args["event_id"]
         origin = args["origin"]
+        traffic.on_received(event_id, name_to_id(origin), name_to_id(server))
+        if traffic.aggregating():
+            return ""
+
         app.logger.info(f"Received {event_id}. {origin} -> {server}")
-        await event_notif_queue.put(
+        await mesh.events.put(
             {
                 "event_type": "receive",
                 "source": origin,
@@ -603,59 +2256,200 @@ async def on_incoming_log():
         event_id = args["event_id"]
         destinations = json.loads(args["destinations"])
         for destination in destinations:
+            path, hop_times = mesh.get_path_timing(
+                name_to_id(server), name_to_id(destination)
+            )
+            traffic.on_sending(
+                event_id, name_to_id(server), name_to_id(destination), path
+            )
+            if traffic.aggregating() or not path:
+                continue
+
             app.logger.info(f"{server} Sending {event_id}. {server} -> {destination}")
-            await event_notif_queue.put(
+            await mesh.events.put(
                 {
                     "event_type": "sending",
                     "source": server,
                     "target": destination,
-                    "path": mesh.get_path(name_to_id(server), name_to_id(destination)),
+                    "path": path,
+                    # when the PDU should reach each server on the path, in ms
+                    "hop_times": hop_times,
                     "event": event_id,
                 }
             )
     return ""
 
 
-@app.websocket("/event_notifs")
-async def event_notifs():
+async def traffic_loop():
+    while True:
+        await asyncio.sleep(1 / args.frame_rate)
+        for mesh in list(meshes.values()):
+            # send the last frame after we stop aggregating too, so the UI
+            # resets
+            aggregating = mesh.traffic.aggregating()
+            frame = mesh.traffic.frame()
+            if aggregating or mesh.traffic.aggregating():
+                await mesh.events.put(frame)
+
+
+async def update_congestion(mesh):
+    servers = list(mesh.get_started_servers().values())
+    results = await asyncio.gather(
+        *(server.get_stats() for server in servers), return_exceptions=True
+    )
+    now = time.monotonic()
+    for server, stats in zip(servers, results):
+        if isinstance(stats, Exception):
+            app.logger.info("Failed to get stats for %d: %s", server.id, stats)
+            continue
+        mesh.update_link_stats(server.id, stats, now)
+
+    if mesh.update_congestion():
+        app.logger.info("Link congestion changed in mesh %s; rerouting", mesh.name)
+        await mesh.safe_rewire()
+
+
+async def congestion_loop():
     while True:
-        msg = await event_notif_queue.get()
+        await asyncio.sleep(args.stats_interval)
+        await asyncio.gather(
+            *(
+                update_congestion(mesh)
+                for mesh in meshes.values()
+                if mesh.cost_function == Mesh.COST_CONGESTION
+            )
+        )
+
+
+async def health_loop():
+    while True:
+        await asyncio.sleep(args.health_interval)
+
+        # keep checking unhealthy servers, so we notice when they come back
+        servers = [
+            (mesh, server)
+            for mesh in meshes.values()
+            for server in mesh.servers.values()
+            if server.ip is not None
+        ]
+        results = await asyncio.gather(
+            *(server.check_health(args.health_timeout) for _, server in servers),
+            return_exceptions=True,
+        )
+        for (mesh, server), result in zip(servers, results):
+            if server.id not in mesh.servers:
+                continue  # removed while we were checking it
+            if isinstance(result, Exception):
+                app.logger.info("Health check failed for %d: %r", server.id, result)
+            await mesh.update_server_health(server, not isinstance(result, Exception))
+
+
+@mesh_websocket("/event_notifs")
+async def event_notifs(mesh):
+    while True:
+        msg = await mesh.events.get()
         await websocket.send(json.dumps(msg))
 
 
-@app.route("/data", methods=["GET"])
-def on_get_data():
+@mesh_route("/data", methods=["GET"])
+def on_get_data(mesh):
+    # the UI asks for the binary format, but plain JSON is handier for tools
+    best = request.accept_mimetypes.best_match(
+        ["application/json", Mesh.D3_COLUMNS_MIMETYPE], "application/json"
+    )
+    if best == Mesh.D3_COLUMNS_MIMETYPE:
+        return Response(mesh.get_d3_columns(), mimetype=Mesh.D3_COLUMNS_MIMETYPE)
     return mesh.get_d3_data()
 
 
-@app.route("/costs", methods=["GET"])
-def on_get_costs():
+@mesh_route("/costs", methods=["GET"])
+def on_get_costs(mesh):
     return jsonify(mesh.get_costs())
 
 
-@app.route("/defaults", methods=["GET"])
-def on_get_defaults():
+@app.route("/resources", methods=["GET"])
+async def on_get_resources():
+    async def get_resources(agent):
+        try:
+            resources = await agent.get_resources()
+        except Exception as e:
+            return {"error": str(e)}
+        resources["starting"] = starting.get(agent.name, 0)
+        return resources
+
+    results = await asyncio.gather(*(get_resources(a) for a in agents.values()))
+    return jsonify(
+        {
+            "memory_watermark": args.memory_watermark * 1024 * 1024,
+            "agents": dict(zip(agents, results)),
+        }
+    )
+
+
+@app.route("/loop_lag", methods=["GET"])
+def on_get_loop_lag():
+    return jsonify(loop_lag.stats())
+
+
+@mesh_route("/failover", methods=["GET"])
+def on_get_failovers(mesh):
+    return jsonify(list(mesh.failovers))
+
+
+@mesh_route("/betweenness", methods=["GET"])
+async def on_get_betweenness(mesh):
+    try:
+        epsilon = float(request.args.get("epsilon", analytics.EPSILON))
+        delta = float(request.args.get("delta", analytics.DELTA))
+        return jsonify(await mesh.get_betweenness(epsilon, delta))
+    except ValueError as e:
+        abort(400, str(e))
+
+
+@mesh_route("/plan", methods=["POST"])
+async def on_plan(mesh):
+    # {
+    #   "positions": { "3": { "x": 120, "y": 562 } },
+    #   "links": [ { "source": 1, "target": 2, "latency": 100 } ],
+    #   "defaults": { "max_latency": 400 }
+    # }
+    changes = await request.get_json()
+    if not changes:
+        abort(400, "No JSON provided!")
+        return
+
+    try:
+        return jsonify(await mesh.plan(changes))
+    except (KeyError, TypeError, ValueError) as e:
+        abort(400, "Invalid changes: %s" % (e,))
+
+
+@mesh_route("/defaults", methods=["GET"])
+def on_get_defaults(mesh):
     return jsonify(mesh.get_defaults())
 
 
-@app.route("/defaults", methods=["PUT"])
-async def on_put_defaults():
+@mesh_route("/defaults", methods=["PUT"])
+async def on_put_defaults(mesh):
     json = await request.get_json()
-    mesh.set_defaults(json)
+    try:
+        mesh.set_defaults(json)
+    except ValueError as e:
+        abort(400, str(e))
+        return
     await mesh.safe_rewire()
     return ""
 
 
-@app.route("/link/<server1>/<server2>/<type>", methods=["PUT"])
-async def on_put_link_health(server1, server2, type):
+@mesh_route("/link/<server1>/<server2>/<type>", methods=["PUT"])
+async def on_put_link_health(mesh, server1, server2, type):
     json = await request.get_json()
-    mesh.set_link_health(int(server1), int(server2), json)
-    await mesh.safe_rewire()
+    await mesh.update_link_health(int(server1), int(server2), json)
     return ""
 
 
-@app.route("/link/<server1>/<server2>/<type>", methods=["DELETE"])
-async def on_delete_link_health(server1, server2, type):
+@mesh_route("/link/<server1>/<server2>/<type>", methods=["DELETE"])
+async def on_delete_link_health(mesh, server1, server2, type):
     json = {}
     json[type] = None
     mesh.set_link_health(int(server1), int(server2), json)
@@ -663,15 +2457,184 @@ async def on_delete_link_health(server1, server2, type):
     return ""
 
 
+@mesh_route("/load", methods=["POST"])
+async def on_start_load(mesh):
+    # {
+    #   "rate": 10,              // messages per second
+    #   "arrivals": "poisson",   // or "burst"
+    #   "burst_size": 10,
+    #   "duration": 60,          // seconds
+    #   "seed": 1,
+    #   "servers": [1, 2, 3]     // defaults to every started server
+    # }
+    if mesh.loadgen and mesh.loadgen.state not in ("finished", "failed"):
+        abort(409, "Load generator already running")
+        return
+
+    params = await request.get_json() or {}
+    server_ids = params.pop("servers", None)
+    if server_ids is None:
+        server_ids = [i for i, s in mesh.servers.items() if s.ip is not None]
+    targets = {}
+    for i in server_ids:
+        if i not in mesh.servers or mesh.servers[i].ip is None:
+            abort(400, "Server %s isn't running" % i)
+            return
+        targets[i] = mesh.servers[i].synapse_url()
+
+    try:
+        mesh.loadgen = LoadGenerator(targets, **params)
+    except (TypeError, ValueError) as e:
+        abort(400, str(e))
+        return
+    asyncio.ensure_future(mesh.loadgen.run())
+    return jsonify(mesh.loadgen.stats())
+
+
+@mesh_route("/load", methods=["GET"])
+def on_get_load(mesh):
+    if not mesh.loadgen:
+        abort(404, "Load generator hasn't been run")
+        return
+    return jsonify(mesh.loadgen.stats())
+
+
+@mesh_route("/load", methods=["DELETE"])
+def on_stop_load(mesh):
+    if mesh.loadgen:
+        mesh.loadgen.stop()
+    return ""
+
+
+def start_timeline(mesh, scenario):
+    """Starts playing a scenario on the mesh, stopping any it was playing
+
+    Raises:
+        ValueError if the scenario is invalid
+    """
+    events = load_scenario(scenario, Mesh.LINK_FIELDS)
+    if mesh.timeline:
+        mesh.timeline.stop()
+    mesh.timeline = Timeline(events, mesh.apply_events, mesh.safe_rewire)
+    asyncio.ensure_future(mesh.timeline.run())
+
+
+@mesh_route("/timeline", methods=["POST"])
+async def on_start_timeline(mesh):
+    # a scenario, c.f. timeline.py
+    scenario = await request.get_json()
+    try:
+        start_timeline(mesh, scenario)
+    except ValueError as e:
+        abort(400, str(e))
+        return
+    return jsonify(mesh.timeline.stats())
+
+
+@mesh_route("/timeline", methods=["GET"])
+def on_get_timeline(mesh):
+    if not mesh.timeline:
+        abort(404, "No timeline has been run")
+        return
+    return jsonify(mesh.timeline.stats())
+
+
+@mesh_route("/timeline", methods=["DELETE"])
+def on_stop_timeline(mesh):
+    if mesh.timeline:
+        mesh.timeline.stop()
+    return ""
+
+
+def get_snapshot():
+    # the default mesh is saved at the top level, as it was before there
+    # were other meshes
+    snapshot = meshes[DEFAULT_MESH].get_snapshot()
+    snapshot["meshes"] = {
+        name: mesh.get_snapshot()
+        for name, mesh in meshes.items()
+        if name != DEFAULT_MESH
+    }
+    return snapshot
+
+
+async def resume(snapshot):
+    running = {}
+    for agent in agents.values():
+        for server_id in await agent.list_hs(all_containers=True):
+            running.setdefault(server_id, {})[agent.name] = agent
+
+    saved_meshes = dict(snapshot.get("meshes", {}))
+    saved_meshes[DEFAULT_MESH] = snapshot
+    for name, saved in sorted(saved_meshes.items()):
+        mesh = meshes.get(name) or create_mesh(name)
+        await mesh.resume(saved, running)
+
+    for server_id in running:
+        # hold on to its ID so we don't try to start a clashing container
+        allocator.claim(server_id)
+        app.logger.warning("Ignoring unknown container synapse%d", server_id)
+
+
+def write_snapshot():
+    data = json.dumps(get_snapshot())
+    tmp_path = args.snapshot + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(data)
+    os.replace(tmp_path, args.snapshot)
+
+
+async def snapshot_loop():
+    last_data = None
+    while True:
+        await asyncio.sleep(args.snapshot_interval)
+        data = json.dumps(get_snapshot())
+        if data != last_data:
+            write_snapshot()
+            last_data = data
+
+
 def cleanup():
-    subprocess.call(["./stop_clean_all.sh"])
+    if args.snapshot:
+        # leave the containers running so that we can --resume them
+        write_snapshot()
+        return
+
+    for agent in agents.values():
+        agent.cleanup()
 
 
 @app.before_first_request
-def setup():
+def setup_cleanup():
     atexit.register(cleanup)
 
 
+@app.before_first_request
+def setup_traffic():
+    asyncio.ensure_future(traffic_loop())
+    asyncio.ensure_future(congestion_loop())
+    asyncio.ensure_future(health_loop())
+    asyncio.ensure_future(loop_lag.run())
+
+
+@app.before_first_request
+async def setup_snapshots():
+    if args.resume:
+        with open(args.snapshot) as f:
+            snapshot = json.load(f)
+        await resume(snapshot)
+
+    if args.snapshot:
+        asyncio.ensure_future(snapshot_loop())
+
+
+@app.before_first_request
+def setup_timeline():
+    if args.scenario:
+        with open(args.scenario) as f:
+            start_timeline(meshes[DEFAULT_MESH], json.load(f))
+
+
 def main():
     global args
 
@@ -705,8 +2668,174 @@ def main():
         help="Debug option to make the CoAP proxy log the packets that are being sent/received",
         action="store_true",
     )
+    parser.add_argument(
+        "--agent",
+        "-a",
+        help="Run homeservers on the hostagent.py daemon at the given URL, as "
+        "NAME=URL[,capacity=N][,address=ADDR]. May be given multiple times. "
+        "Defaults to running everything on the local docker daemon.",
+        action="append",
+        type=parse_agent,
+        default=[],
+    )
+    parser.add_argument(
+        "--max-servers",
+        help="The maximum number of servers which can run at once",
+        default=1000,
+        type=int,
+    )
+    parser.add_argument(
+        "--synapse-ports",
+        help="The first host port for the synapses' client APIs",
+        default=18000,
+        type=int,
+    )
+    parser.add_argument(
+        "--topologiser-ports",
+        help="The first host port for the synapses' topologisers",
+        default=19000,
+        type=int,
+    )
+    parser.add_argument(
+        "--coap-ports",
+        help="The first host port for the synapses' CoAP proxies",
+        default=20000,
+        type=int,
+    )
+    parser.add_argument(
+        "--snapshot",
+        help="Periodically save the mesh's servers, defaults and link overrides "
+        "to this file. Containers are left running on exit so they can be resumed.",
+    )
+    parser.add_argument(
+        "--snapshot-interval",
+        help="How often to save the snapshot, in seconds",
+        default=10,
+        type=float,
+    )
+    parser.add_argument(
+        "--resume",
+        help="Restore the mesh from the --snapshot file, reattaching to its "
+        "running containers rather than starting new ones",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--wire-format",
+        help="The format of the route and health payloads sent to topologisers. "
+        "'compact' refers to servers by ID via a shared directory; 'legacy' "
+        "embeds every server's details in every payload.",
+        choices=["compact", "legacy"],
+        default="compact",
+    )
+    parser.add_argument(
+        "--compress-payloads",
+        help="gzip the payloads sent to topologisers",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--traffic-mode",
+        help="Whether to send the UI a message per PDU ('events'), periodic "
+        "per-link counters ('aggregate') or switch between them depending on "
+        "the event rate ('auto')",
+        choices=TrafficAggregator.MODES,
+        default="auto",
+    )
+    parser.add_argument(
+        "--frame-rate",
+        help="How many aggregated traffic frames to send per second",
+        default=10,
+        type=float,
+    )
+    parser.add_argument(
+        "--aggregate-above",
+        help="In auto mode, the event rate (per second) above which to aggregate",
+        default=100,
+        type=float,
+    )
+    parser.add_argument(
+        "--aggregate-below",
+        help="In auto mode, the event rate (per second) below which to stop "
+        "aggregating",
+        default=50,
+        type=float,
+    )
+    parser.add_argument(
+        "--memory-watermark",
+        help="Don't start servers on hosts with less than this much memory "
+        "available, in MiB",
+        default=512,
+        type=int,
+    )
+    parser.add_argument(
+        "--admission",
+        help="Whether to queue or reject new servers while no host has enough memory",
+        choices=("queue", "reject"),
+        default="queue",
+    )
+    parser.add_argument(
+        "--admission-timeout",
+        help="How long to queue a new server for before rejecting it, in seconds",
+        default=300,
+        type=float,
+    )
+    parser.add_argument(
+        "--stats-interval",
+        help="How often to poll the topologisers' traffic counters when routing "
+        "around congestion, in seconds",
+        default=5,
+        type=float,
+    )
+    parser.add_argument(
+        "--health-interval",
+        help="How often to check that each server's topologiser and synapse are "
+        "responding, in seconds",
+        default=5,
+        type=float,
+    )
+    parser.add_argument(
+        "--health-timeout",
+        help="How long to wait for each health check, in seconds",
+        default=2,
+        type=float,
+    )
+    parser.add_argument(
+        "--health-misses",
+        help="How many health checks in a row a server can fail before it's "
+        "routed around",
+        default=3,
+        type=int,
+    )
+    parser.add_argument(
+        "--scenario",
+        help="Play back the timed link impairments and server failures in this "
+        "file (c.f. timeline.py) on the default mesh once meshsim starts",
+    )
     args = parser.parse_args()
 
+    if args.resume and not args.snapshot:
+        parser.error("--resume requires --snapshot")
+
+    if args.scenario:
+        try:
+            with open(args.scenario) as f:
+                load_scenario(json.load(f), Mesh.LINK_FIELDS)
+        except (OSError, ValueError) as e:
+            parser.error("Can't load --scenario: %s" % (e,))
+
+    global allocator
+    try:
+        allocator = ServerAllocator(
+            synapse_port=args.synapse_ports,
+            topologiser_port=args.topologiser_ports,
+            coap_port=args.coap_ports,
+            size=args.max_servers,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    for agent in args.agent or [HostAgent("local")]:
+        agents[agent.name] = agent
+
     host = args.host
     os.environ["POSTGRES_HOST"] = host
     os.environ["SYNAPSE_LOG_HOST"] = host
@@ -17,9 +17,9 @@
 # You should have received a copy of the GNU General Public License
 # along with coap-proxy.  If not, see <https://www.gnu.org/licenses/>.
 
-if [ "$#" -ne 2 ]
+if [ "$#" -ne 2 ] && [ "$#" -ne 5 ]
 then
-  echo 'Usage: ./start_hs.sh <HS_ID> <DOCKER_HOST_IP>'
+  echo 'Usage: ./start_hs.sh <HS_ID> <DOCKER_HOST_IP> [<SYNAPSE_PORT> <TOPOLOGISER_PORT> <COAP_PORT>]'
   exit 1
 fi
 
@@ -28,6 +28,11 @@ set -x
 HSID=$1
 HOST_IP=$2
 
+# host ports default to 18000 + id, 19000 + id and 20000 + id
+SYNAPSE_PORT=${3:-$((18000 + HSID))}
+TOPOLOGISER_PORT=${4:-$((19000 + HSID))}
+COAP_PORT=${5:-$((20000 + HSID))}
+
 
 # for db in account device mediaapi syncapi roomserver serverkey federationsender publicroomsapi appservice naffka; do
 #     createdb -O dendrite dendrite${HSID}_$db
@@ -69,6 +74,13 @@ EOT
 
 # ensure our network exists with:
 # docker network create --driver bridge mesh
+#
+# or, if spreading the mesh over several hosts with hostagent.py, use an
+# attachable overlay network so that container IPs & MACs are routable between
+# hosts:
+# docker network create --driver overlay --attachable mesh
+#
+# MESH_NETWORK can be used to pick a different network name.
 
 # ensure that KSM is enabled on the host:
 #
@@ -85,7 +97,7 @@ EOT
 
 docker run -d --name synapse$HSID \
 	--privileged \
-	--network mesh \
+	--network ${MESH_NETWORK:-mesh} \
 	--hostname synapse$HSID \
 	-e SYNAPSE_SERVER_NAME=synapse${HSID} \
 	-e SYNAPSE_REPORT_STATS=no \
@@ -93,9 +105,9 @@ docker run -d --name synapse$HSID \
 	-e SYNAPSE_LOG_LEVEL=INFO \
 	-e POSTGRES_DB=synapse$HSID \
 	-e POSTGRES_PASSWORD=synapseftw \
-	-p $((18000 + HSID)):8008 \
-	-p $((19000 + HSID)):3000 \
-	-p $((20000 + HSID)):5683/udp \
+	-p $SYNAPSE_PORT:8008 \
+	-p $TOPOLOGISER_PORT:3000 \
+	-p $COAP_PORT:5683/udp \
 	-e POSTGRES_HOST=$HOST_IP \
 	-e SYNAPSE_LOG_HOST=$HOST_IP \
 	-e SYNAPSE_USE_PROXY=1 \
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 New Vector Ltd
+#
+# This file is part of meshsim.
+#
+# meshsim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# meshsim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with coap-proxy.  If not, see <https://www.gnu.org/licenses/>.
+
+# Sweeps the mesh's wiring parameters offline, to see how they shape the
+# topology without having to start any servers.
+#
+# Each combination of the given parameters is applied to each layout, wired
+# and routed with the controller's own Mesh.wire, and summarised as a row of
+# CSV. Layouts are either scattered at random (seeded from --seed, so the
+# same command always gives the same results) or loaded from meshsim
+# --snapshot files, whose defaults and link overrides are used as a base.
+#
+#   ./sweep.py --layouts 5 --servers 100 --max-latency 100,200,300 \
+#       --neighbour-limit 2,4,8 --cost-function cost_min_latency,cost_max_bandwidth \
+#       --jobs 4 --output sweep.csv
+
+import argparse
+import csv
+import itertools
+import json
+import logging
+import random
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import networkx as nx
+
+from util import int_keys
+
+# the parameters which can be swept, and how to parse their values
+PARAMETERS = (
+    ("max_latency", int),
+    ("min_bandwidth", int),
+    ("latency_scale", int),
+    ("cost_function", str),
+    ("neighbour_limit", int),
+)
+
+COLUMNS = (
+    ["layout"]
+    + [name for name, _ in PARAMETERS]
+    + [
+        "servers",
+        "links",
+        "components",
+        "connectivity",
+        "diameter_hops",
+        "diameter_latency",
+        "stretch_mean",
+        "stretch_max",
+        "degree_mean",
+        "degree_max",
+        "degree_distribution",
+        "max_edge_load",
+    ]
+)
+
+
+def random_layout(seed, count, width, height):
+    rng = random.Random(seed)
+    return [(i, rng.uniform(0, width), rng.uniform(0, height)) for i in range(count)]
+
+
+def evaluate(job):
+    """Wires up a layout with the given parameters and measures the result.
+
+    Args:
+        job (tuple): the layout's name, its servers as (id, x, y), the
+            defaults & link overrides to start from (or None), and the
+            parameters to override them with
+
+    Returns:
+        dict: a row of COLUMNS
+    """
+    # imported here so that only the workers pay for setting up the app
+    import meshsim
+
+    name, positions, snapshot, params = job
+
+    # the servers never start, so their ports don't matter
+    size = max(server_id for server_id, _, _ in positions) + 1
+    meshsim.allocator = meshsim.ServerAllocator(
+        synapse_port=0, topologiser_port=size, coap_port=2 * size, size=size
+    )
+
+    mesh = meshsim.Mesh("")
+    if snapshot:
+        mesh.set_defaults(snapshot["defaults"])
+        mesh.overrides = snapshot["overrides"]
+    mesh.set_defaults(params)
+
+    for server_id, x, y in positions:
+        server = meshsim.Server(x, y, server_id)
+        server.ip = "0.0.0.0"  # so that it counts as started
+        mesh.servers[server.id] = server
+        mesh.graph.add_node(server.id)
+
+    servers = mesh.get_started_servers()
+    mesh.wire(servers)
+
+    row = dict(params, layout=name)
+    row.update(_measure(mesh, servers))
+    return row
+
+
+def _measure(mesh, servers):
+    n = len(servers)
+    pairs = n * (n - 1)
+
+    reachable = 0
+    diameter_hops = 0
+    diameter_latency = 0
+    edge_loads = Counter()
+    for source_id in servers:
+        for dest_id, path in mesh.paths.get(source_id, {}).items():
+            if dest_id == source_id:
+                continue
+            reachable += 1
+            diameter_hops = max(diameter_hops, len(path) - 1)
+            latency = 0
+            for a, b in zip(path, path[1:]):
+                latency += mesh.get_latency(servers[a], servers[b])
+                edge_loads[(a, b) if a < b else (b, a)] += 1
+            diameter_latency = max(diameter_latency, latency)
+
+    stretch = mesh.get_stretch(servers)
+    degrees = [len(server.neighbours) for server in servers.values()]
+
+    return {
+        "servers": n,
+        "links": mesh.graph.number_of_edges(),
+        "components": nx.number_connected_components(mesh.graph),
+        "connectivity": round(reachable / pairs, 6) if pairs else 1,
+        "diameter_hops": diameter_hops,
+        "diameter_latency": round(diameter_latency, 3),
+        "stretch_mean": _round(stretch["mean"]),
+        "stretch_max": _round(stretch["max"]),
+        "degree_mean": round(sum(degrees) / n, 3) if n else 0,
+        "degree_max": max(degrees, default=0),
+        "degree_distribution": " ".join(
+            "%d:%d" % item for item in sorted(Counter(degrees).items())
+        ),
+        # the fraction of routes which use the busiest link
+        "max_edge_load": round(max(edge_loads.values(), default=0) / pairs, 6)
+        if pairs
+        else 0,
+    }
+
+
+def _round(value):
+    return None if value is None else round(value, 6)
+
+
+def load_snapshot(path):
+    with open(path) as f:
+        snapshot = json.load(f)
+    positions = [(s["id"], s["x"], s["y"]) for s in snapshot["servers"]]
+    overrides = int_keys(snapshot.get("overrides", {}), depth=2)
+    return (
+        positions,
+        {"defaults": snapshot.get("defaults", {}), "overrides": overrides},
+    )
+
+
+def parse_values(parse):
+    def parse_list(spec):
+        try:
+            return [parse(value) for value in spec.split(",")]
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+
+    return parse_list
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sweeps the mesh's wiring parameters over a set of layouts."
+    )
+    for name, parse in PARAMETERS:
+        parser.add_argument(
+            "--" + name.replace("_", "-"),
+            help="Comma separated values of %s to try" % name,
+            type=parse_values(parse),
+        )
+    parser.add_argument(
+        "--snapshot",
+        help="A meshsim --snapshot file to use as a layout",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--layouts", help="How many random layouts to generate", default=0, type=int
+    )
+    parser.add_argument(
+        "--servers", help="How many servers in each random layout", default=50, type=int
+    )
+    parser.add_argument("--width", default=1000, type=float)
+    parser.add_argument("--height", default=1000, type=float)
+    parser.add_argument("--seed", help="Seeds the random layouts", default=0, type=int)
+    parser.add_argument(
+        "--jobs", help="How many processes to wire layouts in", default=None, type=int
+    )
+    parser.add_argument("--output", help="Where to write the CSV (default stdout)")
+    args = parser.parse_args()
+
+    if not args.layouts and not args.snapshot:
+        parser.error("Give some --layouts to generate or --snapshot files to load")
+
+    layouts = []
+    rng = random.Random(args.seed)
+    for i in range(args.layouts):
+        layout_seed = rng.getrandbits(32)
+        layouts.append(
+            (
+                "random-%d" % layout_seed,
+                random_layout(layout_seed, args.servers, args.width, args.height),
+                None,
+            )
+        )
+    for path in args.snapshot:
+        positions, snapshot = load_snapshot(path)
+        layouts.append((path, positions, snapshot))
+
+    # only sweep the parameters we were given values for
+    grid = [
+        (name, getattr(args, name)) for name, _ in PARAMETERS if getattr(args, name)
+    ]
+    jobs = [
+        (name, positions, snapshot, dict(zip((n for n, _ in grid), values)))
+        for name, positions, snapshot in layouts
+        for values in itertools.product(*(values for _, values in grid))
+    ]
+
+    logging.basicConfig(level=logging.INFO)
+    logging.info("Evaluating %d combinations", len(jobs))
+
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        writer = csv.DictWriter(output, COLUMNS, restval="")
+        writer.writeheader()
+        with ProcessPoolExecutor(args.jobs) as pool:
+            # map keeps the rows in order, however the work is spread out
+            for row in pool.map(evaluate, jobs):
+                writer.writerow(row)
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
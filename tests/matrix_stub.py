@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 New Vector Ltd
+#
+# This file is part of meshsim.
+#
+# meshsim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# meshsim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with coap-proxy.  If not, see <https://www.gnu.org/licenses/>.
+
+# A stub of just enough of the Matrix client API for loadgen.py: whoami,
+# creating & joining rooms, sending messages, /sync (including leaving events
+# out once there are more than the filter's limit) and /messages.
+#
+# The servers share one event stream, so everything is federated instantly.
+#
+#   python tests/matrix_stub.py --servers 2 --port 18000
+
+import argparse
+import asyncio
+import json
+
+from aiohttp import web
+
+
+class Hub(object):
+    """The state shared by all the stub servers"""
+
+    def __init__(self):
+        self.events = []  # (room id, event), in stream order
+        self.aliases = {}  # alias -> room id
+        self.members = {}  # room id -> server ids
+        self.changed = asyncio.Condition()
+
+    async def append(self, room_id, event):
+        async with self.changed:
+            self.events.append((room_id, event))
+            self.changed.notify_all()
+
+
+def _position(token):
+    # our tokens are "s" followed by a position in the hub's stream
+    return int(token[1:])
+
+
+def make_app(hub, server_id):
+    app = web.Application()
+    user_id = "@matthew:synapse%d" % server_id
+    prefix = "/_matrix/client/r0"
+
+    async def whoami(request):
+        return web.json_response({"user_id": user_id})
+
+    async def create_room(request):
+        body = await request.json()
+        room_id = "!%d:synapse%d" % (len(hub.members), server_id)
+        hub.members[room_id] = {server_id}
+        if "room_alias_name" in body:
+            hub.aliases["#%s:synapse%d" % (body["room_alias_name"], server_id)] = room_id
+        return web.json_response({"room_id": room_id})
+
+    async def join(request):
+        room = request.match_info["room"]
+        room_id = hub.aliases.get(room, room)
+        if room_id not in hub.members:
+            return web.json_response({"errcode": "M_NOT_FOUND"}, status=404)
+        hub.members[room_id].add(server_id)
+        return web.json_response({"room_id": room_id})
+
+    async def send(request):
+        room_id = request.match_info["room_id"]
+        event_id = "$%d:synapse%d" % (len(hub.events), server_id)
+        await hub.append(
+            room_id,
+            {
+                "event_id": event_id,
+                "type": request.match_info["event_type"],
+                "sender": user_id,
+                "content": await request.json(),
+            },
+        )
+        return web.json_response({"event_id": event_id})
+
+    async def sync(request):
+        limit = json.loads(request.query.get("filter", "{}"))
+        limit = limit.get("room", {}).get("timeline", {}).get("limit", 10)
+        since = request.query.get("since")
+        position = _position(since) if since else 0
+        # we cap long polls so that shutting down doesn't wait on them
+        timeout = min(int(request.query.get("timeout", 0)) / 1000, 1)
+
+        if since and timeout:
+            async with hub.changed:
+                try:
+                    await asyncio.wait_for(
+                        hub.changed.wait_for(lambda: len(hub.events) > position),
+                        timeout,
+                    )
+                except asyncio.TimeoutError:
+                    pass
+
+        end = len(hub.events)
+        rooms = {}
+        for room_id, members in hub.members.items():
+            if server_id not in members:
+                continue
+            indexes = [
+                i
+                for i in range(position, end)
+                if hub.events[i][0] == room_id
+            ]
+            shown = indexes[-limit:]
+            rooms[room_id] = {
+                "timeline": {
+                    "events": [hub.events[i][1] for i in shown],
+                    "limited": len(shown) < len(indexes),
+                    "prev_batch": "s%d" % (shown[0] if shown else end),
+                }
+            }
+        return web.json_response(
+            {"next_batch": "s%d" % end, "rooms": {"join": rooms}}
+        )
+
+    async def messages(request):
+        room_id = request.match_info["room_id"]
+        start = _position(request.query["from"])
+        stop = _position(request.query.get("to", "s0"))
+        limit = int(request.query.get("limit", 10))
+        if request.query.get("dir") != "b":
+            return web.json_response({"errcode": "M_UNRECOGNIZED"}, status=400)
+
+        indexes = [i for i in range(stop, start) if hub.events[i][0] == room_id]
+        shown = indexes[-limit:][::-1]
+        response = {
+            "chunk": [hub.events[i][1] for i in shown],
+            "start": "s%d" % start,
+        }
+        if shown:
+            response["end"] = "s%d" % shown[-1]
+        return web.json_response(response)
+
+    app.router.add_get(prefix + "/account/whoami", whoami)
+    app.router.add_post(prefix + "/createRoom", create_room)
+    app.router.add_post(prefix + "/join/{room}", join)
+    app.router.add_put(prefix + "/rooms/{room_id}/send/{event_type}/{txn_id}", send)
+    app.router.add_get(prefix + "/sync", sync)
+    app.router.add_get(prefix + "/rooms/{room_id}/messages", messages)
+    return app
+
+
+async def start(count, host="localhost", port=0):
+    """Starts `count` stub servers sharing a hub.
+
+    Returns:
+        tuple[list[web.AppRunner], dict[int, str]]: the runners, to clean up,
+        and the base URL of each server by ID
+    """
+    hub = Hub()
+    runners = []
+    targets = {}
+    for server_id in range(count):
+        runner = web.AppRunner(make_app(hub, server_id))
+        await runner.setup()
+        site = web.TCPSite(runner, host, port + server_id if port else 0)
+        await site.start()
+        bound_port = runner.addresses[0][1]
+        runners.append(runner)
+        targets[server_id] = "http://%s:%d" % (host, bound_port)
+    return runners, targets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub Matrix servers for loadgen.")
+    parser.add_argument("--servers", default=2, type=int)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument(
+        "--port", help="The port of the first server", default=18000, type=int
+    )
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    _, targets = loop.run_until_complete(start(args.servers, args.host, args.port))
+    for server_id, url in sorted(targets.items()):
+        print("synapse%d at %s" % (server_id, url))
+    loop.run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# Copyright 2019 New Vector Ltd
+#
+# This file is part of meshsim.
+#
+# meshsim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# meshsim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with coap-proxy.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+
+import networkx as nx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analytics  # noqa: E402
+
+
+def mesh_graph(n, seed):
+    # servers scattered at random, linked to those nearby with their
+    # distance as the cost, much as the threshold topology wires them
+    graph = nx.random_geometric_graph(n, 0.08, seed=seed)
+    for a, b, attrs in graph.edges(data=True):
+        (x1, y1), (x2, y2) = graph.nodes[a]["pos"], graph.nodes[b]["pos"]
+        attrs["weight"] = round(((x2 - x1) ** 2 + (y2 - y1) ** 2) ** 0.5 * 1000)
+    return graph
+
+
+class BetweennessTest(unittest.TestCase):
+    def test_small_meshes_are_exact(self):
+        graph = mesh_graph(200, seed=1)
+        nodes, edges, samples = analytics.betweenness(graph, seed=1)
+        self.assertIsNone(samples)
+        self.assertEqual(nodes, analytics._exact(graph))
+
+    def test_samples_big_meshes(self):
+        graph = mesh_graph(700, seed=1)
+        nodes, edges, samples = analytics.betweenness(graph, seed=1)
+        self.assertIsNotNone(samples)
+        self.assertLess(samples, graph.number_of_nodes())
+
+        exact_nodes = analytics._exact(graph)
+        exact_edges = analytics._exact_edges(graph)
+        self.assertEqual(set(nodes), set(exact_nodes))
+        self.assertEqual(set(edges), set(exact_edges))
+        # every estimate should be within epsilon, bar bad luck with
+        # probability delta
+        self.assertLess(
+            max(abs(nodes[i] - exact_nodes[i]) for i in nodes), analytics.EPSILON
+        )
+        self.assertLess(
+            max(abs(edges[e] - exact_edges[e]) for e in edges), analytics.EPSILON
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
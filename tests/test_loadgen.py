@@ -0,0 +1,77 @@
+# Copyright 2019 New Vector Ltd
+#
+# This file is part of meshsim.
+#
+# meshsim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# meshsim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with coap-proxy.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import loadgen  # noqa: E402
+import matrix_stub  # noqa: E402
+
+
+class LoadGeneratorTest(unittest.TestCase):
+    def run_against_stub(self, servers, **params):
+        async def run():
+            runners, targets = await matrix_stub.start(servers)
+            try:
+                return await loadgen.LoadGenerator(targets, **params).run()
+            finally:
+                for runner in runners:
+                    await runner.cleanup()
+
+        return asyncio.run(run())
+
+    def test_run(self):
+        stats = self.run_against_stub(
+            3, rate=50, duration=1, seed=1, drain_time=1, join_timeout=5
+        )
+        self.assertEqual(stats["state"], "finished")
+        self.assertEqual(stats["servers"], [0, 1, 2])
+        self.assertGreater(stats["sent"], 0)
+        self.assertEqual(stats["failed"], 0)
+        self.assertEqual(stats["send_latency"]["count"], stats["sent"])
+        # every message turns up on the two servers which didn't send it
+        self.assertEqual(stats["sync_latency"]["count"], 2 * stats["sent"])
+        self.assertEqual(stats["sync_missing"], 0)
+
+    def test_limited_syncs_are_backfilled(self):
+        # bursts bigger than a sync will return
+        with mock.patch.object(loadgen, "SYNC_LIMIT", 3):
+            stats = self.run_against_stub(
+                2,
+                rate=100,
+                arrivals="burst",
+                burst_size=20,
+                duration=1,
+                seed=1,
+                drain_time=1,
+                join_timeout=5,
+            )
+        self.assertEqual(stats["state"], "finished")
+        self.assertGreater(stats["limited_syncs"], 0)
+        self.assertEqual(stats["failed_backfills"], 0)
+        self.assertEqual(stats["sync_latency"]["count"], stats["sent"])
+        self.assertEqual(stats["sync_missing"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,234 @@
+# Copyright 2019 New Vector Ltd
+#
+# This file is part of meshsim.
+#
+# meshsim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# meshsim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with coap-proxy.  If not, see <https://www.gnu.org/licenses/>.
+
+# Plays back a scenario of timed link impairments and server failures.
+#
+# A scenario is JSON of the form:
+#
+#   {
+#       "events": [
+#           // pin some of a link's characteristics, as PUT /link does
+#           {"at": 0, "link": [1, 2], "set": {"bandwidth": 100000}},
+#           {"at": 10, "link": [1, 2], "set": {"bandwidth": 50000}},
+#           // go back to the defaults, as DELETE /link does
+#           {"at": 20, "link": [1, 2], "clear": ["bandwidth"]},
+#           // take a server out of the mesh and put it back
+#           {"at": 5, "server": 4, "state": "down"},
+#           {"at": 15, "server": 4, "state": "up"},
+#           // events can repeat until a given time, e.g. to flap a link
+#           // every 30s for 5 minutes
+#           {"at": 0, "every": 60, "until": 300, "link": [3, 7],
+#            "set": {"packet_loss": 100}},
+#           {"at": 30, "every": 60, "until": 300, "link": [3, 7],
+#            "clear": ["packet_loss"]}
+#       ]
+#   }
+#
+# where "at" is in seconds from the start of the scenario. Events are run off
+# a monotonic clock. Every event which is due when we wake up is applied
+# together, followed by a single rewire, so events which fall due while we
+# are still rewiring are batched up into the next tick rather than each
+# causing their own rewire.
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+from loadgen import percentiles
+
+logger = logging.getLogger(__name__)
+
+SERVER_STATES = ("up", "down")
+
+
+def load_scenario(scenario, fields):
+    """Checks a scenario and expands its repeating events.
+
+    Args:
+        scenario (dict): as described above
+        fields (iterable[str]): the link characteristics which can be set
+
+    Returns:
+        list[dict]: the events, in the order they should be applied, with
+        links as (lower id, higher id)
+
+    Raises:
+        ValueError if the scenario is invalid
+    """
+    if not isinstance(scenario, dict) or not isinstance(
+        scenario.get("events"), list
+    ):
+        raise ValueError("Scenario must have a list of events")
+
+    fields = set(fields)
+    events = []
+    for i, spec in enumerate(scenario["events"]):
+        try:
+            event = _load_event(spec, fields)
+            at = float(spec["at"])
+            every = float(spec.get("every", 0))
+            until = float(spec.get("until", at))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError("Invalid event %d: %s" % (i, e))
+        if at < 0 or every < 0:
+            raise ValueError("Invalid event %d: times must be positive" % (i,))
+
+        repeats = int((until - at) // every) if every and until > at else 0
+        for repeat in range(repeats + 1):
+            events.append(dict(event, at=at + repeat * every))
+
+    # sorting is stable, so simultaneous events are applied in file order
+    events.sort(key=lambda event: event["at"])
+    return events
+
+
+def _load_event(spec, fields):
+    if "link" in spec:
+        server1_id, server2_id = (int(i) for i in spec["link"])
+        event = {"link": (min(server1_id, server2_id), max(server1_id, server2_id))}
+        if ("set" in spec) == ("clear" in spec):
+            raise ValueError("link events need one of 'set' or 'clear'")
+        if "set" in spec:
+            event["set"] = {field: int(value) for field, value in spec["set"].items()}
+            changed = event["set"]
+        else:
+            event["clear"] = list(spec["clear"])
+            changed = event["clear"]
+        unknown = set(changed) - fields
+        if unknown:
+            raise ValueError("unknown link fields %s" % ", ".join(sorted(unknown)))
+        return event
+
+    if "server" in spec:
+        if spec.get("state") not in SERVER_STATES:
+            raise ValueError("server events need a 'state' of 'up' or 'down'")
+        return {"server": int(spec["server"]), "state": spec["state"]}
+
+    raise ValueError("events need a 'link' or a 'server'")
+
+
+def describe(event):
+    if "server" in event:
+        return "server %d %s" % (event["server"], event["state"])
+    if "set" in event:
+        change = ", ".join("%s=%d" % item for item in sorted(event["set"].items()))
+    else:
+        change = "clear " + ", ".join(event["clear"])
+    return "link %d-%d %s" % (event["link"] + (change,))
+
+
+class Timeline(object):
+    """Applies a scenario's events as they fall due.
+
+    Args:
+        events (list[dict]): as returned by load_scenario
+        apply (callable): applies a list of events to the mesh, without
+            rewiring it
+        rewire (callable): returns an awaitable which rewires the mesh
+        history (int): how many applied events (and how late they were) to
+            remember for `stats`
+    """
+
+    def __init__(self, events, apply, rewire, history=1000):
+        self.events = events
+        self.apply = apply
+        self.rewire = rewire
+
+        self.state = "idle"
+        self.error = None
+        self.applied = 0
+        self.ticks = 0
+        # how late the most recently applied events were, in seconds
+        self.lateness = deque(maxlen=history)
+        # the most recently applied events, with when they were scheduled and
+        # applied relative to the start of the scenario
+        self.history = deque(maxlen=history)
+
+        self._start = None
+        self._stopping = None
+
+    async def run(self):
+        self._stopping = asyncio.Event()
+        self._start = time.monotonic()
+        self.state = "running"
+        try:
+            index = 0
+            while index < len(self.events):
+                delay = self._start + self.events[index]["at"] - time.monotonic()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._stopping.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                if self._stopping.is_set():
+                    break
+
+                elapsed = time.monotonic() - self._start
+                due = []
+                while index < len(self.events) and self.events[index]["at"] <= elapsed:
+                    due.append(self.events[index])
+                    index += 1
+                if not due:
+                    continue  # woken up a little early
+
+                self.apply(due)
+                self._record(due, time.monotonic() - self._start)
+                await self.rewire()
+                self.ticks += 1
+
+            self.state = "stopped" if self._stopping.is_set() else "finished"
+        except Exception as e:
+            logger.exception("Timeline failed")
+            self.state = "failed"
+            self.error = str(e)
+
+    def stop(self):
+        if self._stopping:
+            self._stopping.set()
+
+    def _record(self, events, applied_at):
+        for event in events:
+            late = applied_at - event["at"]
+            logger.info(
+                "Applied %s at %.3fs, scheduled for %.3fs (%.1fms late)",
+                describe(event),
+                applied_at,
+                event["at"],
+                late * 1000,
+            )
+            self.applied += 1
+            self.lateness.append(late)
+            self.history.append(
+                {
+                    "event": describe(event),
+                    "scheduled": round(event["at"], 6),
+                    "applied": round(applied_at, 6),
+                }
+            )
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "error": self.error,
+            "elapsed": time.monotonic() - self._start if self._start else 0,
+            "events": len(self.events),
+            "applied": self.applied,
+            "ticks": self.ticks,
+            "lateness": percentiles(self.lateness),
+            "history": list(self.history),
+        }
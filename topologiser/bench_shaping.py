@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 New Vector Ltd
+#
+# This file is part of meshsim.
+#
+# meshsim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# meshsim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with coap-proxy.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compares the linear and hashed peer classifiers from shaping.py.
+#
+# Sets up a veth pair between two network namespaces, shapes the sending side
+# with N peers (N-1 made up, plus the real receiver last, which is the worst
+# case for the linear filter chain) and then measures:
+#
+#  * accuracy: the rate achieved by a UDP flood vs the configured bandwidth
+#  * cpu: the sender's CPU time per packet with an unconstrained rate, vs
+#    the same with no shaping at all
+#
+# Needs root (for `ip netns`), e.g.:
+#
+#   sudo ./bench_shaping.py --peers 1,16,256 --rate 10000000
+
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+from shaping import hashed_commands, linear_commands
+
+TX_NS = "meshsim_bench_tx"
+RX_NS = "meshsim_bench_rx"
+TX_IP = "10.250.0.1"
+RX_IP = "10.250.0.2"
+GATEWAY = "10.250.0.254"
+PORT = 9999
+
+# udp + ip + ethernet headers
+OVERHEAD = 8 + 20 + 14
+
+
+def sh(*cmd, ns=None, input=None):
+    if ns:
+        cmd = ("ip", "netns", "exec", ns) + cmd
+    return subprocess.run(
+        cmd, check=True, capture_output=True, text=True, input=input
+    ).stdout
+
+
+def setup_namespaces():
+    teardown_namespaces()
+    sh("ip", "netns", "add", TX_NS)
+    sh("ip", "netns", "add", RX_NS)
+    sh(
+        "ip", "link", "add", "veth0", "netns", TX_NS,
+        "type", "veth", "peer", "name", "veth1", "netns", RX_NS,
+    )
+    sh("ip", "addr", "add", TX_IP + "/24", "dev", "veth0", ns=TX_NS)
+    sh("ip", "addr", "add", RX_IP + "/24", "dev", "veth1", ns=RX_NS)
+    sh("ip", "link", "set", "veth0", "up", ns=TX_NS)
+    sh("ip", "link", "set", "veth1", "up", ns=RX_NS)
+
+    # `ip netns exec` remounts /sys for the namespace
+    rx_mac = sh("cat", "/sys/class/net/veth1/address", ns=RX_NS).strip()
+
+    # so the sender doesn't need to ARP
+    sh("ip", "neigh", "add", RX_IP, "lladdr", rx_mac, "dev", "veth0", ns=TX_NS)
+    return rx_mac
+
+
+def teardown_namespaces():
+    for ns in (TX_NS, RX_NS):
+        subprocess.run(["ip", "netns", "del", ns], capture_output=True)
+
+
+def make_peers(count, rx_mac, bandwidth, rng):
+    peers = []
+    for _ in range(count - 1):
+        mac = "02:42:%s" % ":".join("%02x" % rng.randrange(256) for _ in range(4))
+        peers.append(
+            {"peer": {"mac": mac}, "bandwidth": bandwidth, "latency": 0, "jitter": 0}
+        )
+    peers.append(
+        {"peer": {"mac": rx_mac}, "bandwidth": bandwidth, "latency": 0, "jitter": 0}
+    )
+    return peers
+
+
+def apply_shaping(classifier, peers, no_netem=False):
+    if classifier == "none":
+        commands = ["qdisc del dev veth0 root"]
+    else:
+        builder = hashed_commands if classifier == "hashed" else linear_commands
+        commands = builder("veth0", GATEWAY, peers, [], 1500 + OVERHEAD + 1)
+
+    if no_netem:
+        commands = [re.sub(r" (netem .*|sfq)$", " pfifo", c) for c in commands]
+    out = subprocess.run(
+        ["ip", "netns", "exec", TX_NS, "tc", "-force", "-batch", "-"],
+        input="\n".join(commands) + "\n",
+        capture_output=True,
+        text=True,
+    )
+    # the first command deletes the root qdisc, which may well not exist
+    if out.returncode and "Command failed -:1\n" != out.stderr[-len("Command failed -:1\n"):]:
+        raise Exception("Failed to apply %s shaping: %s" % (classifier, out.stderr))
+
+
+def run_sender(duration, size, count):
+    """Runs inside the tx namespace"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    payload = b"\0" * size
+    sent = 0
+
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    end = time.monotonic() + duration
+    while (count and sent < count) or (not count and time.monotonic() < end):
+        try:
+            sock.sendto(payload, (RX_IP, PORT))
+            sent += 1
+        except OSError:
+            # the qdisc is full
+            pass
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    cpu = (usage.ru_utime - start_usage.ru_utime) + (
+        usage.ru_stime - start_usage.ru_stime
+    )
+    print(json.dumps({"sent": sent, "cpu": cpu}))
+
+
+def run_receiver(duration):
+    """Runs inside the rx namespace"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 24)
+    sock.bind((RX_IP, PORT))
+    sock.settimeout(1)
+
+    packets = 0
+    size = 0
+    first = last = None
+    end = time.monotonic() + duration + 2
+    while time.monotonic() < end:
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            continue
+        now = time.monotonic()
+        if first is None:
+            first = now
+            end = first + duration
+        last = now
+        packets += 1
+        size = len(data)
+
+    print(json.dumps({"packets": packets, "size": size, "elapsed": (last or 0) - (first or 0)}))
+
+
+def spawn(ns, *args):
+    return subprocess.Popen(
+        ["ip", "netns", "exec", ns, sys.executable, os.path.abspath(__file__)]
+        + list(args),
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+
+
+def measure_accuracy(duration, size, rate):
+    receiver = spawn(RX_NS, "--receive", str(duration))
+    time.sleep(0.5)
+    sender = spawn(TX_NS, "--send", str(duration + 1), str(size), "0")
+    sender.communicate()
+    received = json.loads(receiver.communicate()[0])
+
+    if received["packets"] < 2 or not received["elapsed"]:
+        return 0
+    achieved = (received["packets"] - 1) * (received["size"] + OVERHEAD) * 8
+    return achieved / received["elapsed"] / rate
+
+
+def measure_cpu(size, count):
+    receiver = spawn(RX_NS, "--receive", "5")
+    time.sleep(0.5)
+    sender = spawn(TX_NS, "--send", "0", str(size), str(count))
+    sent = json.loads(sender.communicate()[0])
+    receiver.kill()
+    return sent["cpu"] / sent["sent"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark peer classifiers")
+    parser.add_argument("--peers", default="1,16,64,256")
+    parser.add_argument("--classifiers", default="linear,hashed")
+    parser.add_argument(
+        "--rate", type=int, default=10000000, help="Shaped bandwidth in bps"
+    )
+    parser.add_argument("--size", type=int, default=1000, help="UDP payload size")
+    parser.add_argument("--duration", type=float, default=3)
+    parser.add_argument(
+        "--packets", type=int, default=200000, help="Packets to send for CPU runs"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--no-netem",
+        help="Use pfifo rather than netem & sfq leaves, for kernels without them",
+        action="store_true",
+    )
+    parser.add_argument("--send", nargs=3, help=argparse.SUPPRESS)
+    parser.add_argument("--receive", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.send:
+        run_sender(float(args.send[0]), int(args.send[1]), int(args.send[2]))
+        return
+    if args.receive:
+        run_receiver(float(args.receive))
+        return
+
+    rng = random.Random(args.seed)
+    rx_mac = setup_namespaces()
+    try:
+        apply_shaping("none", [])
+        baseline = measure_cpu(args.size, args.packets)
+        print("baseline: %.0fns/packet unshaped" % (baseline * 1e9))
+
+        print("classifier  peers  accuracy  cpu/packet  overhead/packet")
+        for classifier in args.classifiers.split(","):
+            for count in [int(c) for c in args.peers.split(",")]:
+                peers = make_peers(count, rx_mac, args.rate, rng)
+                apply_shaping(classifier, peers, args.no_netem)
+                accuracy = measure_accuracy(args.duration, args.size, args.rate)
+
+                # now see what classification costs when we're not rate limited
+                peers[-1]["bandwidth"] = 10 * 1000 * 1000 * 1000
+                apply_shaping(classifier, peers, args.no_netem)
+                cpu = measure_cpu(args.size, args.packets)
+
+                print(
+                    "%-10s  %5d  %7.1f%%  %8.0fns  %13.0fns"
+                    % (
+                        classifier,
+                        count,
+                        accuracy * 100,
+                        cpu * 1e9,
+                        (cpu - baseline) * 1e9,
+                    )
+                )
+    finally:
+        teardown_namespaces()
+
+
+if __name__ == "__main__":
+    main()
@@ -17,11 +17,22 @@
 # You should have received a copy of the GNU General Public License
 # along with coap-proxy.  If not, see <https://www.gnu.org/licenses/>.
 
+# stop at the first tc failure rather than shaping the peer half way
+set -e
+
 PEERID=$1
 M0=$2; M1=$3; M2=$4; M3=$5; M4=$6; M5=$7
-BW=$8
-DELAY=$9
-JITTER=${10}
+# meshsim's characteristics can be floats (e.g. 123.0), which bash's
+# arithmetic can't handle, so we truncate them
+BW=${8%.*}
+DELAY=${9%.*}
+JITTER=${10%.*}
+LOSS=${11:-0}
+DUPLICATE=${12:-0}
+REORDER=${13:-0}
+CORRUPT=${14:-0}
+# "tbf" for a tbf with a netem beneath it, or "netem" to do it all in netem
+PROFILE=${15:-tbf}
 
 #      root 1: prio
 #           /|\
@@ -84,8 +95,24 @@ BURST=$((`cat /sys/class/net/eth0/mtu` + 14 + 1))
 # otherwise we're going to always get 40s for free where everything works fine before suddenly the
 # rate limiting kicks in.  It might be better to just have a better TC module...
 
-tc qdisc add dev eth0 parent 1:$PEERID handle ${PEERID}0: tbf rate ${BW}bit burst $BURST limit 10000
-tc qdisc add dev eth0 parent ${PEERID}0:1 handle ${PEERID}1: netem delay ${DELAY}ms ${JITTER}ms 25%
+IMPAIRMENTS="loss ${LOSS}% duplicate ${DUPLICATE}% corrupt ${CORRUPT}%"
+# netem only reorders packets which it's delaying
+if [ "$REORDER" != "0" ]; then
+    IMPAIRMENTS="$IMPAIRMENTS reorder ${REORDER}%"
+fi
+
+if [ "$PROFILE" == "netem" ]; then
+    # netem's built-in rate limiting saves each packet going through a second
+    # qdisc. Its limit is in packets, and covers the ones it's delaying as
+    # well as queueing, so we allow for what's in flight over the delay &
+    # jitter on top of the same 10000 bytes as the tbf.
+    LIMIT=$(( (BW * (DELAY + JITTER) / 8000 + 10000 + BURST - 1) / BURST ))
+    LIMIT=$(( LIMIT > 0 ? LIMIT : 1 ))
+    tc qdisc add dev eth0 parent 1:$PEERID handle ${PEERID}0: netem rate ${BW}bit delay ${DELAY}ms ${JITTER}ms 25% $IMPAIRMENTS limit $LIMIT
+else
+    tc qdisc add dev eth0 parent 1:$PEERID handle ${PEERID}0: tbf rate ${BW}bit burst $BURST limit 10000
+    tc qdisc add dev eth0 parent ${PEERID}0:1 handle ${PEERID}1: netem delay ${DELAY}ms ${JITTER}ms 25% $IMPAIRMENTS
+fi
 
 tc filter add dev eth0 protocol ip parent 1: \
     u32 match u16 0x0800 0xFFFF at -2 \
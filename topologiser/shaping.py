@@ -0,0 +1,271 @@
+# Copyright 2019 New Vector Ltd
+#
+# This file is part of meshsim.
+#
+# meshsim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# meshsim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with coap-proxy.  If not, see <https://www.gnu.org/licenses/>.
+
+# Builds `tc -batch` scripts for shaping traffic to our peers.
+#
+# set_hs_peer_health.sh adds one u32 filter per peer under a prio qdisc, so
+# every packet walks a chain of filters as long as our list of peers, and prio
+# can't have more than 16 bands anyway. The "hashed" classifier here instead
+# puts an HTB class per peer under the root, and finds the right class by
+# hashing on the last byte of the destination MAC (or the source port, for
+# client traffic) into u32 hash tables, so classification is O(1) however
+# many peers we have.
+#
+#      root 1: htb (default 1:1)
+#           /|\
+#          / | \
+#         /  |  \
+#        /   |   \
+#      1:1  1:2  1:3 ...        <- one htb class per peer/client, limited to
+#       |    |    |                their bandwidth
+#      10: 1002: 1003:
+#      sfq netem netem          <- delay & jitter
+#
+# and the filters look like:
+#
+#   800:: (root) -- dst ip == gateway, hash on sport --> 200: [256 buckets]
+#                -- ethertype ip, hash on dst mac ----> 100: [256 buckets]
+#
+# with each bucket then matching the full MAC (or port) of its peers (or
+# clients).
+#
+# Both classifiers support two shaping profiles:
+#
+#  * "tbf" limits each peer's bandwidth with a token bucket (a tbf qdisc, or
+#    the htb class itself), with a netem qdisc beneath it for delay, jitter
+#    and other impairments.
+#  * "netem" does the lot in a single netem qdisc per peer, using its
+#    built-in `rate`, so each packet only goes through one qdisc.
+#
+# Either way, the kernel keeps counts of what's been sent & dropped to each
+# peer, which parse_stats picks out of `tc -s` so that meshsim can route
+# around congested links.
+
+import re
+
+# The handles of our hash tables
+PEER_TABLE = 0x100
+CLIENT_TABLE = 0x200
+
+# the ports which client traffic comes from (see set_client_health.sh)
+CLIENT_PORTS = (5683, 8008)
+
+
+def _rate(bandwidth):
+    # htb & netem both choke on a zero rate
+    return "%dbit" % max(int(bandwidth), 8)
+
+
+# how much we let queue up for each peer when netem is rate limiting, as
+# set_hs_peer_health.sh's tbfs do. netem's limit is in packets, though, and
+# also covers the packets in its delay line, c.f. _netem_limit.
+NETEM_LIMIT_BYTES = 10000
+
+
+def _netem_limit(peer, burst):
+    """How many packets netem has to hold to keep the link full for its
+    latency & jitter, on top of the queue the tbfs would allow.
+    """
+    in_flight = (
+        int(peer["bandwidth"]) * (int(peer["latency"]) + int(peer["jitter"])) // 8000
+    )
+    return max(-(-(in_flight + NETEM_LIMIT_BYTES) // burst), 1)
+
+
+def _netem(peer, burst=None):
+    """The netem parameters for a peer (or client), including its rate if
+    we're given a burst size, i.e. when netem is doing the rate limiting.
+    """
+    params = "delay %dms %dms 25%%" % (int(peer["latency"]), int(peer["jitter"]))
+
+    # clients call it loss rather than packet_loss
+    loss = peer.get("packet_loss", peer.get("loss"))
+    for name, value in (
+        ("loss", loss),
+        ("duplicate", peer.get("duplicate")),
+        ("reorder", peer.get("reorder")),
+        ("corrupt", peer.get("corrupt")),
+    ):
+        if value:
+            params += " %s %s%%" % (name, value)
+
+    if burst:
+        params = "rate %s %s limit %d" % (
+            _rate(peer["bandwidth"]),
+            params,
+            _netem_limit(peer, burst),
+        )
+    return params
+
+
+def hashed_commands(dev, gateway, peers, clients, burst, profile="tbf"):
+    """Builds the tc batch commands to shape traffic using hashed classifiers.
+
+    Args:
+        dev (str): the interface to shape, e.g. eth0
+        gateway (str): the IP of the docker host, whose traffic is unshaped
+            unless it's to a client
+        peers (list[dict]): the peers to shape, as in the /health payload
+        clients (list[dict]): the clients to shape, as in the /health payload
+        burst (int): the burst size for the token buckets, in bytes
+        profile (str): "tbf" to rate limit with the htb classes, or "netem"
+            to leave that to the netem qdiscs
+
+    Returns:
+        list[str]: tc commands, without the leading `tc`
+    """
+    commands = [
+        "qdisc del dev %s root" % dev,
+        "qdisc add dev %s root handle 1: htb default 1" % dev,
+        "class add dev %s parent 1: classid 1:1 htb rate 10gbit quantum %d"
+        % (dev, burst),
+        "qdisc add dev %s parent 1:1 handle 10: sfq" % dev,
+        "filter add dev %s parent 1: prio 1 handle %x: protocol ip u32 divisor 256"
+        % (dev, PEER_TABLE),
+        "filter add dev %s parent 1: prio 1 handle %x: protocol ip u32 divisor 256"
+        % (dev, CLIENT_TABLE),
+        # client traffic first, as it's also addressed to the gateway's MAC.
+        # the source port is the top half of the first word of the IP
+        # payload, at offset 20 (assuming no IP options), and we hash on its
+        # low byte.
+        "filter add dev %s parent 1: prio 1 protocol ip u32 ht 800:: "
+        "match ip dst %s/32 hashkey mask 0x00ff0000 at 20 link %x:"
+        % (dev, gateway, CLIENT_TABLE),
+        # then everything else by the last byte of its destination MAC
+        "filter add dev %s parent 1: prio 1 protocol ip u32 ht 800:: "
+        "match u16 0x0800 0xffff at -2 hashkey mask 0x000000ff at -12 link %x:"
+        % (dev, PEER_TABLE),
+    ]
+
+    i = 2  # 1:1 is the default class
+    for peer in peers:
+        mac = peer["peer"]["mac"].split(":")
+        commands += _class_commands(dev, i, peer, burst, profile)
+        commands.append(
+            "filter add dev %s parent 1: prio 1 protocol ip u32 ht %x:%s: "
+            "match u32 0x%s 0xffffffff at -12 match u16 0x%s 0xffff at -14 "
+            "flowid 1:%x" % (dev, PEER_TABLE, mac[5], "".join(mac[2:]), "".join(mac[:2]), i)
+        )
+        i += 1
+
+    for client in clients:
+        commands += _class_commands(dev, i, client, burst, profile)
+        for port in CLIENT_PORTS:
+            commands.append(
+                "filter add dev %s parent 1: prio 1 protocol ip u32 ht %x:%x: "
+                "match ip dst %s/32 match ip sport %d 0xffff flowid 1:%x"
+                % (dev, CLIENT_TABLE, port & 0xFF, gateway, port, i)
+            )
+        i += 1
+
+    return commands
+
+
+def _class_commands(dev, i, peer, burst, profile):
+    if profile == "netem":
+        # the class just classifies, and netem does the rate limiting
+        rate = "10gbit"
+        netem = _netem(peer, burst)
+    else:
+        rate = _rate(peer["bandwidth"])
+        netem = _netem(peer)
+
+    return [
+        "class add dev %s parent 1: classid 1:%x htb rate %s ceil %s "
+        "burst %d cburst %d quantum %d" % (dev, i, rate, rate, burst, burst, burst),
+        "qdisc add dev %s parent 1:%x handle %x: netem %s"
+        % (dev, i, 0x1000 + i, netem),
+    ]
+
+
+def peer_handle(classifier, i):
+    """The qdisc (for the linear classifier) or class (for hashed) which
+    counts the traffic to the i-th peer (from 2), as `tc -s` prints it.
+    """
+    if classifier == "hashed":
+        return "1:%x" % i
+    # set_hs_peer_health.sh's tbf qdiscs. tc reads the handle as hex.
+    return "%d0:" % i
+
+
+_STATS = re.compile(
+    r"^(?:qdisc|class) \S+ (?P<handle>[0-9a-f]*:[0-9a-f]*) .*\n"
+    r"\s*Sent (?P<bytes>\d+) bytes (?P<packets>\d+) pkt "
+    r"\(dropped (?P<drops>\d+), overlimits (?P<overlimits>\d+) requeues \d+\)\s*\n"
+    r"\s*backlog (?P<backlog>\d+)(?P<unit>[KM]?)b",
+    re.MULTILINE,
+)
+
+_UNITS = {"": 1, "K": 1024, "M": 1024 * 1024}
+
+
+def parse_stats(output):
+    """Parses the output of `tc -s qdisc show` or `tc -s class show`.
+
+    (`tc -j` would be nicer, but doesn't do classes on older iproute2s.)
+
+    Returns:
+        dict[str, dict[str, int]]: the bytes, packets, drops, overlimits and
+        backlog (in bytes) of each qdisc or class, by handle
+    """
+    return {
+        m.group("handle"): {
+            "bytes": int(m.group("bytes")),
+            "packets": int(m.group("packets")),
+            "drops": int(m.group("drops")),
+            "overlimits": int(m.group("overlimits")),
+            "backlog": int(m.group("backlog")) * _UNITS[m.group("unit")],
+        }
+        for m in _STATS.finditer(output)
+    }
+
+
+def linear_commands(dev, gateway, peers, clients, burst):
+    """Builds the equivalent of clear_hs_peer_health.sh and
+    set_hs_peer_health.sh, with one u32 filter per peer under a prio qdisc.
+
+    This is only used for benchmarking against the hashed classifier, so it
+    doesn't bother with client traffic. As prio is limited to 16 bands, peers
+    beyond the 15th share bands.
+    """
+    bands = min(len(peers) + 1, 16)
+    commands = [
+        "qdisc del dev %s root" % dev,
+        "qdisc add dev %s root handle 1: prio bands %d priomap %s"
+        % (dev, max(bands, 2), " ".join(["0"] * 16)),
+        "qdisc add dev %s parent 1:1 handle 10: sfq" % dev,
+        "filter add dev %s protocol ip parent 1: u32 match ip dst %s flowid 1:1"
+        % (dev, gateway),
+    ]
+
+    for i, peer in enumerate(peers):
+        band = 2 + i % (bands - 1)
+        mac = peer["peer"]["mac"].split(":")
+        if i < bands - 1:
+            commands += [
+                "qdisc add dev %s parent 1:%x handle %x0: tbf rate %s burst %d limit 10000"
+                % (dev, band, band, _rate(peer["bandwidth"]), burst),
+                "qdisc add dev %s parent %x0:1 handle %x1: netem %s"
+                % (dev, band, band, _netem(peer)),
+            ]
+        commands.append(
+            "filter add dev %s protocol ip parent 1: u32 match u16 0x0800 0xffff at -2 "
+            "match u32 0x%s 0xffffffff at -12 match u16 0x%s 0xffff at -14 "
+            "flowid 1:%x" % (dev, "".join(mac[2:]), "".join(mac[:2]), band)
+        )
+
+    return commands
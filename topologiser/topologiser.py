@@ -19,12 +19,15 @@
 
 import os
 import sys
+import gzip
 import json
 from flask import Flask, request, abort, jsonify, send_from_directory
 import subprocess
 import requests
 import psycopg2
 
+from shaping import hashed_commands, parse_stats, peer_handle
+
 
 abspath = os.path.abspath(__file__)
 dname = os.path.dirname(abspath)
@@ -44,6 +47,42 @@ POSTGRES_HOST = os.environ.get("POSTGRES_HOST", "db")
 POSTGRES_PORT = os.environ.get("POSTGRES_PORT", 5432)
 
 
+# The IP & MAC of every server in the mesh, as sent by meshsim. Compact
+# route and health payloads refer to servers by ID via this.
+directory = {
+    "version": None,
+    "servers": {},
+}
+
+
+# Which qdiscs or classes count the traffic to each peer, as set up by the
+# last /health. `generation` is bumped every time we rebuild them, which
+# resets their counters.
+shaped = {
+    "classifier": None,
+    "generation": 0,
+    "peers": [],  # (peer id, handle)
+}
+
+
+def get_payload():
+    data = request.get_data()
+    if request.headers.get("Content-Encoding") == "gzip":
+        data = gzip.decompress(data)
+    return json.loads(data)
+
+
+def get_server(server_id):
+    ip, mac = directory["servers"][server_id]
+    return {"id": server_id, "ip": ip, "mac": mac}
+
+
+def check_directory_version(payload):
+    # meshsim will resend the directory if we don't have the right one
+    if payload["directory_version"] != directory["version"]:
+        abort(409, "Unknown directory version")
+
+
 def run(cmd):
     out = subprocess.run(
         cmd,
@@ -55,18 +94,94 @@ def run(cmd):
         result += "\n<<<\n" + out.stdout
     if out.stderr:
         result += "\n<!!\n" + out.stderr
+    if out.returncode:
+        result += "\n<!! exited with %d" % out.returncode
     return result
 
 
+def run_batch(commands):
+    # -force keeps going after errors, e.g. deleting a root qdisc which
+    # isn't there
+    out = subprocess.run(
+        ["tc", "-force", "-batch", "-"],
+        input="\n".join(commands) + "\n",
+        capture_output=True,
+        text=True,
+    )
+    result = "\n>>> tc -batch (%d commands)" % len(commands)
+    if out.stdout:
+        result += "\n<<<\n" + out.stdout
+    if out.stderr:
+        result += "\n<!!\n" + out.stderr
+    return result
+
+
+def get_burst():
+    # see set_hs_peer_health.sh for why we pick MTU + 14 + 1
+    with open("/sys/class/net/eth0/mtu") as f:
+        return int(f.read()) + 14 + 1
+
+
+def get_gateway():
+    with open("/tmp/gw") as f:
+        return f.read().strip()
+
+
+@app.route("/directory", methods=["PUT"])
+def set_directory():
+    # {
+    #     version: 3,
+    #     servers: {
+    #         <id>: [<ip>, <mac>], ...
+    #     }
+    # }
+    payload = get_payload()
+    directory["version"] = payload["version"]
+    directory["servers"] = {
+        int(server_id): entry for server_id, entry in payload["servers"].items()
+    }
+    return ''
+
+
 @app.route("/routes", methods=["PUT"])
 def set_routes():
+    # either the legacy format:
     # [
     #   {
     #       dst: server,
     #       via: server
     #   }, ...
     # ]
-    routes = request.get_json()
+    #
+    # or the compact format:
+    # {
+    #     version: 2,
+    #     directory_version: 3,
+    #     source: 1, # our own server ID
+    #     next_hops: [null, 2, 2, 5, ...], # next hop server ID, by destination ID
+    #     costs: [null, 12.5, 30, 8, ...], # path cost, by destination ID
+    # }
+    routes = get_payload()
+
+    if isinstance(routes, dict):
+        check_directory_version(routes)
+        next_hops = routes['next_hops']
+        costs = routes['costs']
+        # as with the legacy format, every other server gets an entry, with
+        # no cost if it's unreachable
+        routes = [
+            {
+                "dst": get_server(server_id),
+                "via": (
+                    get_server(next_hops[server_id])
+                    if server_id < len(next_hops) and
+                    next_hops[server_id] is not None else None
+                ),
+                "cost": costs[server_id] if server_id < len(costs) else None,
+            }
+            for server_id in directory["servers"]
+            if server_id != routes.get('source')
+        ]
 
     dest_to_costs = {}
 
@@ -109,7 +224,66 @@ def set_network_health():
     #         }, ...
     #     ]
     # }
-    json = request.get_json()
+    #
+    # or in the compact format, with peers given as arrays of each field:
+    # {
+    #     version: 2,
+    #     directory_version: 3,
+    #     peers: {
+    #         id: [2, 5, ...],
+    #         bandwidth: [300, ...],
+    #         latency: [200, ...],
+    #         jitter: [20, ...],
+    #         packet_loss: [0, ...], # % of packets to drop
+    #         duplicate: [0, ...], # % of packets to duplicate
+    #         reorder: [0, ...], # % of packets to send straight away
+    #         corrupt: [0, ...], # % of packets to flip a bit of
+    #     },
+    #     clients: [ ... ],
+    # }
+    #
+    # either format may also have:
+    #
+    #     shaping: {
+    #         classifier: "linear" | "hashed",
+    #         profile: "tbf" | "netem",
+    #     }
+    json = get_payload()
+
+    if json.get('version') == 2:
+        check_directory_version(json)
+        peers = json['peers']
+        # older meshsims don't send the other impairments
+        zeros = [0] * len(peers['id'])
+        json['peers'] = [
+            {
+                "peer": get_server(peer_id),
+                "bandwidth": peers['bandwidth'][i],
+                "latency": peers['latency'][i],
+                "jitter": peers['jitter'][i],
+                "packet_loss": peers['packet_loss'][i],
+                "duplicate": peers.get('duplicate', zeros)[i],
+                "reorder": peers.get('reorder', zeros)[i],
+                "corrupt": peers.get('corrupt', zeros)[i],
+            }
+            for i, peer_id in enumerate(peers['id'])
+        ]
+
+    shaping = json.get('shaping', {})
+    classifier = shaping.get('classifier', 'linear')
+    profile = shaping.get('profile', 'tbf')
+    shaped["classifier"] = classifier
+    shaped["generation"] += 1
+    shaped["peers"] = [
+        (peer['peer'].get('id'), peer_handle(classifier, i))
+        for i, peer in enumerate(json['peers'], 2)
+    ]
+
+    if classifier == 'hashed':
+        return run_batch(hashed_commands(
+            "eth0", get_gateway(), json['peers'], json['clients'], get_burst(),
+            profile,
+        ))
 
     i = 2  # we start adding the queues from 1:2, as 1:1 is the default queue
     flow_count = len(json['peers']) + len(json['clients']) + 1
@@ -125,7 +299,15 @@ def set_network_health():
         result += run(
             ["./set_hs_peer_health.sh", str(i)] +
             mac +
-            [str(peer['bandwidth']), str(peer['latency']), str(peer['jitter'])]
+            [
+                str(int(peer[field]))
+                for field in ('bandwidth', 'latency', 'jitter')
+            ] +
+            [
+                str(peer.get(impairment) or 0)
+                for impairment in ('packet_loss', 'duplicate', 'reorder', 'corrupt')
+            ] +
+            [profile]
         )
         i = i + 1
 
@@ -137,6 +319,44 @@ def set_network_health():
 
     return result
 
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    # the counters for the traffic we've shaped to each peer since the
+    # last /health:
+    # {
+    #     generation: 4,
+    #     peers: {
+    #         id: [2, 5, ...],
+    #         bytes: [123456, ...],
+    #         packets: [1234, ...],
+    #         drops: [0, ...],
+    #         overlimits: [12, ...],
+    #         backlog: [1514, ...], # bytes queued right now
+    #     }
+    # }
+    fields = ("bytes", "packets", "drops", "overlimits", "backlog")
+    peers = {"id": []}
+    peers.update({field: [] for field in fields})
+
+    if shaped["peers"]:
+        # one tc for everything, rather than one per peer
+        out = subprocess.run(
+            ["tc", "-s", "class" if shaped["classifier"] == "hashed" else "qdisc",
+             "show", "dev", "eth0"],
+            capture_output=True,
+            text=True,
+        )
+        stats = parse_stats(out.stdout)
+        for peer_id, handle in shaped["peers"]:
+            if handle not in stats:
+                continue
+            peers["id"].append(peer_id)
+            for field in fields:
+                peers[field].append(stats[handle][field])
+
+    return jsonify({"generation": shaped["generation"], "peers": peers})
+
+
 def write_destination_health(dest_to_cost):
     conn = psycopg2.connect(
         database=POSTGRES_DB,
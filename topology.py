@@ -0,0 +1,283 @@
+# Copyright 2019 New Vector Ltd
+#
+# This file is part of meshsim.
+#
+# meshsim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# meshsim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with coap-proxy.  If not, see <https://www.gnu.org/licenses/>.
+
+# Strategies for deciding which servers in a mesh get linked to which.
+#
+# The original (and default) "threshold" strategy considers every pair of
+# servers, which is O(n^2). The others derive their links from a Delaunay
+# triangulation or k-d tree of server positions, which is O(n log n), so we
+# can model meshes of thousands of nodes.
+
+from itertools import combinations
+from math import atan2, pi
+
+from scipy.spatial import Delaunay, QhullError, cKDTree
+
+
+class TopologyStrategy(object):
+    """Decides which servers are linked to which.
+
+    Subclasses implement `candidates`, returning the pairs of servers which
+    should be linked. Links are still subject to the mesh's max_latency and
+    min_bandwidth thresholds.
+    """
+
+    name = None
+
+    def wire(self, mesh, servers, cost_function):
+        """Connects up the given servers, whose neighbours have been reset,
+        adding the resulting links to mesh.graph weighted by cost_function.
+
+        Args:
+            mesh (Mesh)
+            servers (dict[int, Server]): the servers to wire, by ID
+            cost_function (callable): gives the cost of a link between two
+                servers
+        """
+        for server1, server2 in self.candidates(mesh, servers):
+            if mesh.within_thresholds(server1, server2):
+                server1.connect(server2)
+                mesh.graph.add_edge(
+                    server1.id, server2.id, weight=cost_function(server1, server2)
+                )
+
+    def candidates(self, mesh, servers):
+        raise NotImplementedError()
+
+
+class ThresholdStrategy(TopologyStrategy):
+    """Links every pair of servers within the mesh's thresholds, then keeps
+    only the cheapest `neighbour_limit` links of each server.
+    """
+
+    name = "threshold"
+
+    def wire(self, mesh, servers, cost_function):
+        limit = mesh.neighbour_limit
+
+        # first we wire anyone closer together than our thresholds
+        for server1, server2 in combinations(servers.values(), 2):
+            if mesh.within_thresholds(server1, server2):
+                server1.connect(server2)
+
+        # then we reset the wirings and rewire the closest N neighbours.
+        # we do this in two phases as we need to have all the possible
+        # neighbours in place from both 'i' and 'j' sides of the matrix before
+        # we know which are actually closest.
+        for server in servers.values():
+            neighbour_costs = {
+                s.id: cost_function(server, s) for s in server.neighbours
+            }
+            server.reset_neighbours()
+            # break ties by ID, so that we wire the same way every time
+            closest = sorted(neighbour_costs.items(), key=lambda x: (x[1], x[0]))
+            for (j, cost) in closest[0:limit]:
+                if server.connect(servers[j], limit):
+                    mesh.graph.add_edge(server.id, j, weight=cost)
+
+
+def _positions(servers):
+    ids = list(servers)
+    return ids, [(servers[i].x, servers[i].y) for i in ids]
+
+
+def _max_distance(mesh):
+    """The furthest apart two servers can be and still be within max_latency
+    (ignoring any latency overrides).
+    """
+    if mesh.latency_scale <= 0:
+        return float("inf")
+    return mesh.max_latency * 100 / mesh.latency_scale
+
+
+def _delaunay_neighbours(points):
+    """Returns the neighbours of each point in the Delaunay triangulation of
+    `points`, as a list of sets of indices.
+    """
+    n = len(points)
+    if n < 4:
+        # too few points to triangulate (and any triangle's edges are all
+        # Delaunay anyway)
+        return [set(j for j in range(n) if j != i) for i in range(n)]
+
+    try:
+        # QJ joggles the input so that every point ends up in the
+        # triangulation, even if there are duplicates
+        tri = Delaunay(points, qhull_options="QJ")
+    except QhullError:
+        # everything is collinear, so the triangulation is just a line
+        order = sorted(range(n), key=lambda i: points[i])
+        neighbours = [set() for _ in range(n)]
+        for i, j in zip(order, order[1:]):
+            neighbours[i].add(j)
+            neighbours[j].add(i)
+        return neighbours
+
+    indptr, indices = tri.vertex_neighbor_vertices
+    return [set(indices[indptr[i] : indptr[i + 1]]) for i in range(n)]
+
+
+def _squared_distance(p, q):
+    return (p[0] - q[0]) ** 2 + (p[1] - q[1]) ** 2
+
+
+class DelaunayStrategy(TopologyStrategy):
+    """Links servers which are neighbours in the Delaunay triangulation.
+    """
+
+    name = "delaunay"
+
+    def candidates(self, mesh, servers):
+        ids, points = _positions(servers)
+        neighbours = _delaunay_neighbours(points)
+        for i, js in enumerate(neighbours):
+            for j in js:
+                if i < j and self.keep(points, neighbours, i, j):
+                    yield servers[ids[i]], servers[ids[j]]
+
+    def keep(self, points, neighbours, i, j):
+        return True
+
+
+class GabrielStrategy(DelaunayStrategy):
+    """Links servers whose diametral circle contains no other server.
+
+    The Gabriel graph is a subgraph of the Delaunay triangulation, and an edge
+    of the latter can only be blocked by one of the vertices of its adjacent
+    triangles, so we only need to check the common neighbours.
+    """
+
+    name = "gabriel"
+
+    def keep(self, points, neighbours, i, j):
+        d = _squared_distance(points[i], points[j])
+        for k in neighbours[i] & neighbours[j]:
+            if (
+                _squared_distance(points[i], points[k])
+                + _squared_distance(points[j], points[k])
+                < d
+            ):
+                return False
+        return True
+
+
+class RelativeNeighbourhoodStrategy(DelaunayStrategy):
+    """Links servers with no other server closer to both of them.
+
+    The relative neighbourhood graph is a subgraph of the Delaunay
+    triangulation, and any server which blocks an edge must be a Delaunay
+    neighbour of one of its ends.
+    """
+
+    name = "rng"
+
+    def keep(self, points, neighbours, i, j):
+        d = _squared_distance(points[i], points[j])
+        for k in neighbours[i] | neighbours[j]:
+            if k == i or k == j:
+                continue
+            if max(
+                _squared_distance(points[i], points[k]),
+                _squared_distance(points[j], points[k]),
+            ) < d:
+                return False
+        return True
+
+
+class NearestNeighbourStrategy(TopologyStrategy):
+    """Links each server to its `knn_k` nearest servers within range.
+    """
+
+    name = "knn"
+
+    def candidates(self, mesh, servers):
+        ids, points = _positions(servers)
+        if len(points) < 2:
+            return
+
+        k = min(mesh.knn_k, len(points) - 1)
+        tree = cKDTree(points)
+        _, indices = tree.query(
+            points, k=k + 1, distance_upper_bound=_max_distance(mesh)
+        )
+
+        seen = set()
+        for i, row in enumerate(indices):
+            for j in row:
+                # missing neighbours are returned as len(points)
+                if j == i or j >= len(points):
+                    continue
+                pair = (min(i, j), max(i, j))
+                if pair not in seen:
+                    seen.add(pair)
+                    yield servers[ids[pair[0]]], servers[ids[pair[1]]]
+
+
+class YaoStrategy(TopologyStrategy):
+    """Divides the space around each server into `yao_cones` equal cones and
+    links it to the nearest server in each.
+
+    To keep this O(n log n) we only look at the nearest few servers (4 per
+    cone) when searching each cone, which only misses links in very
+    unevenly spread meshes.
+    """
+
+    name = "yao"
+
+    def candidates(self, mesh, servers):
+        ids, points = _positions(servers)
+        if len(points) < 2:
+            return
+
+        cones = mesh.yao_cones
+        k = min(cones * 4, len(points) - 1)
+        tree = cKDTree(points)
+        _, indices = tree.query(
+            points, k=k + 1, distance_upper_bound=_max_distance(mesh)
+        )
+
+        seen = set()
+        for i, row in enumerate(indices):
+            nearest_per_cone = {}
+            # the results are sorted by distance, so the first in each cone wins
+            for j in row:
+                if j == i or j >= len(points):
+                    continue
+                angle = atan2(
+                    points[j][1] - points[i][1], points[j][0] - points[i][0]
+                )
+                cone = int((angle + pi) / (2 * pi) * cones) % cones
+                nearest_per_cone.setdefault(cone, j)
+
+            for j in nearest_per_cone.values():
+                pair = (min(i, j), max(i, j))
+                if pair not in seen:
+                    seen.add(pair)
+                    yield servers[ids[pair[0]]], servers[ids[pair[1]]]
+
+
+STRATEGIES = {
+    strategy.name: strategy()
+    for strategy in (
+        ThresholdStrategy,
+        DelaunayStrategy,
+        GabrielStrategy,
+        RelativeNeighbourhoodStrategy,
+        NearestNeighbourStrategy,
+        YaoStrategy,
+    )
+}
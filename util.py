@@ -0,0 +1,31 @@
+# Copyright 2019 New Vector Ltd
+#
+# This file is part of meshsim.
+#
+# meshsim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# meshsim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with coap-proxy.  If not, see <https://www.gnu.org/licenses/>.
+
+
+def int_keys(mapping, depth=1):
+    """Turns the keys of a dict which has been through JSON (which turns int
+    keys into strings) back into ints.
+
+    Args:
+        mapping (dict)
+        depth (int): how many levels of nested dicts to convert, e.g. 2 for
+            link overrides, which are keyed by the server at each end
+    """
+    return {
+        int(key): int_keys(value, depth - 1) if depth > 1 else value
+        for key, value in mapping.items()
+    }